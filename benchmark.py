@@ -0,0 +1,93 @@
+from lib import *
+import argparse
+import sys
+
+# Accessing command-line arguments
+arg_parser = argparse.ArgumentParser(description="Times Parser.parse, CodeGen.generate_compiled_code and Simulator.run on generated programs.")
+arg_parser.add_argument("--sizes", default="100,1000,10000,100000", help="Comma separated program sizes in instructions.")
+arg_parser.add_argument("--cores", default="1,2,4,8", help="Comma separated core counts.")
+arg_parser.add_argument("--scheduler", default=None, help="CodeGen scheduler: 'balance' or 'critical_path'. Defaults to 'critical_path' when the latency table has a forwarding latency, otherwise 'balance'.")
+arg_parser.add_argument("--repeat", type=int, default=3, help="Runs of each measurement, the fastest is kept.")
+arg_parser.add_argument("--baseline", default="benchmark_baseline.json", help="Baseline file to compare against or save to.")
+arg_parser.add_argument("--save", action="store_true", help="Save the results as the new baseline instead of comparing.")
+arg_parser.add_argument("--tolerance", type=float, default=1.25, help="Slowdown over the baseline reported as a regression.")
+args = arg_parser.parse_args()
+
+sizes = [int(size) for size in args.sizes.split(",")]
+core_counts = [int(cores) for cores in args.cores.split(",")]
+
+# Times a function, keeping the fastest of the repeated runs. Prints from the compiler are discarded
+def best_time(function, *function_args):
+    best, result = None, None
+    for _ in range(args.repeat):
+        with redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function(*function_args)
+            elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+# Parses without the DFG, which shells out to graphviz and is not part of the compiler
+def parse(code):
+    return Parser().parse(code, dfg=None)[0]
+
+# Simulates on a new Simulator every time, since running changes its memory
+def simulate(num_PEs, program, mem, fast):
+    simulator = Simulator(num_PEs, "")
+    simulator.MEM.update(mem)
+    return simulator.run(program, fast=fast, trace=TRACE_OFF)
+
+results = {}
+for size in sizes:
+    code = generate_program(size, seed=size)
+    mem = {f"x{address}": float(address + 1) for address in range(4)}
+    parse_time, IR = best_time(parse, code)
+    for cores in core_counts:
+        code_gen = CodeGen(cores, scheduler=args.scheduler)
+        compile_time, program = best_time(code_gen.generate_compiled_code, IR, False)
+        simulate_time, cycles = best_time(simulate, cores, program, mem, False)
+        simulate_fast_time, _ = best_time(simulate, cores, program, mem, True)
+        results[f"{size}x{cores}"] = {
+            "instructions": size,
+            "IR_size": len(IR),
+            "cores": cores,
+            "cycles": cycles,
+            "parse": round(parse_time, 6),
+            "compile": round(compile_time, 6),
+            "simulate": round(simulate_time, 6),
+            "simulate_fast": round(simulate_fast_time, 6),
+        }
+
+# Comparing against the baseline, unless saving a new one
+baseline = {}
+if not args.save and os.path.isfile(args.baseline):
+    with open(args.baseline, "r") as handler:
+        baseline = json.load(handler)
+
+timings = ["parse", "compile", "simulate", "simulate_fast"]
+regressions = []
+print(f"{'Instructions':>12} {'IR Size':>8} {'Cores':>5} {'Cycles':>8} " + " ".join(f"{timing + ' (s)':>18}" for timing in timings))
+for key, result in results.items():
+    columns = []
+    for timing in timings:
+        column = f"{result[timing]:.4f}"
+        if key in baseline and baseline[key][timing] > 0:
+            ratio = result[timing] / baseline[key][timing]
+            column += f" x{ratio:.2f}"
+            if ratio > args.tolerance:
+                column += "!"
+                regressions.append(f"{key} {timing}")
+        columns.append(f"{column:>18}")
+    print(f"{result['instructions']:>12} {result['IR_size']:>8} {result['cores']:>5} {result['cycles']:>8} " + " ".join(columns))
+
+if args.save:
+    with open(args.baseline, "w") as handler:
+        json.dump(results, handler, indent=4)
+    print(f"Saved baseline to '{args.baseline}'")
+elif not baseline:
+    print(f"No baseline at '{args.baseline}'. Run with --save to record one.")
+elif regressions:
+    print(f"Slower than the baseline by more than x{args.tolerance}: {', '.join(regressions)}")
+    sys.exit(1)
+else:
+    print(f"No regressions against '{args.baseline}'")
@@ -0,0 +1,13 @@
+import os
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "request(request_id): the backlog request a test covers, such as 'user-021'")
+
+
+# lib reads 'input/operation_latency.json' relative to the working directory, so tests run from the repository root
+@pytest.fixture(autouse=True)
+def repository_root(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
@@ -1,22 +1,37 @@
 from lib import *
 import sys
 
-# Accessing command-line arguments
-arguments = sys.argv
+create_folders()
 
-if len(arguments) != 4:
-    raise ValueError(f"Need 3 Arguments: '[filename] [core count]', Got {len(arguments)-1} arguments!")
+# Accessing command-line arguments. '--profile' profiles every compiler phase and '--no-dfg' skips the DFG,
+# which needs graphviz's 'dot' to render. Both can appear anywhere
+arguments = [argument for argument in sys.argv if argument not in ["--profile", "--no-dfg"]]
+profiler = Profiler() if "--profile" in sys.argv else None
+dfg = None if "--no-dfg" in sys.argv else "render"
+
+if len(arguments) not in [4, 5]:
+    raise ValueError(f"Need 3 or 4 Arguments: '[source code file name] [memory file name] [core count] [scheduler]', Got {len(arguments)-1} arguments!")
 
 # Extracting command-line arguments
 source_code_file_name = arguments[1]
 memory_file_name = arguments[2]
 multi_core_count = arguments[3]
 
-if not multi_core_count.isdigit():
-    raise ValueError(f"Core Count is not a digit! Got '{multi_core_count}' instead?")
+# A range of core counts, such as '1-8', sweeps every core count in the range
+core_count_range = multi_core_count.split("-")
+if len(core_count_range) > 2 or not all(count.isdigit() for count in core_count_range):
+    raise ValueError(f"Core Count is not a digit or a range of digits! Got '{multi_core_count}' instead?")
 
 # Converting the multi_core_count to an integer
-multi_core_count = int(arguments[3])
+core_count_range = [int(count) for count in core_count_range]
+multi_core_count = core_count_range[-1]
+
+# The sweep compiles in worker processes, which the profiler cannot follow
+if len(core_count_range) == 2 and profiler:
+    raise ValueError(f"'--profile' profiles a single core count, but got the range '{arguments[3]}'!")
+
+# Scheduler used to distribute instructions amongst PEs, by default the one suited to the forwarding latency
+scheduler = arguments[4] if len(arguments) == 5 else default_scheduler(load_latency_table(input_folder + 'operation_latency.json')[3])
 
 # Checking if source code file and memory file exist in the 'input' folder
 if not os.path.isfile(input_folder + source_code_file_name):
@@ -32,9 +47,20 @@ memory_file_name = input_folder + arguments[2]
 with open(source_code_file_name, "r") as handler:
     content = handler.read()
 
-# Parsing the source code using the Parser class
-parse_instance = Parser()
-IR, depend, indep, line_depend = parse_instance.parse(content)
+# Looking up the parsed IR in the compile cache, and parsing the source code using the Parser class on a miss
+compile_cache = CompileCache()
+ir_key = compile_cache.key(content)
+# Profiling always compiles, so the profile covers every phase
+parsed = compile_cache.get(ir_key) if profiler is None else None
+if parsed is None:
+    parse_instance = Parser()
+    if profiler:
+        parse_instance.add_hook(profiler)
+    parsed = parse_instance.parse(content, dfg=dfg)
+    compile_cache.put(ir_key, parsed)
+else:
+    print(f"Loaded IR of '{source_code_file_name}' from the compile cache")
+IR, depend, indep, line_depend = parsed
 
 print(f"Generating IR from '{source_code_file_name}'")
 print('"""')
@@ -42,20 +68,89 @@ pprint(IR)
 print('"""')
 print("\n\n\n")
 
+# Formats the smallest and largest size of a phase over its calls, or one size when they are the same
+def format_size(size_range):
+    if size_range is None:
+        return "None"
+    if size_range[0] == size_range[1]:
+        return str(size_range[0])
+    return f"{size_range[0]}-{size_range[1]}"
+
+# Prints the profile of the compiler phases and writes it to a JSON file
+def write_profile():
+    profiler.stop()
+    report = profiler.report()
+    print(f"{'Phase':<30} {'Calls':>6} {'Wall Time (s)':>14} {'Size Before':>12} {'Size After':>11} {'Peak Memory (B)':>16}")
+    for name, record in report.items():
+        print(f"{name:<30} {record['calls']:>6} {record['wall_time']:>14} {format_size(record['size_before']):>12} {format_size(record['size_after']):>11} {record['peak_memory']:>16}")
+    with open(output_folder + "profile.json", "w") as handler:
+        json.dump(report, handler, indent=4)
+    print(f"Wrote profile to '{output_folder}profile.json'")
+    print("\n\n\n")
+
+# Sweeping the range of core counts in parallel, instead of comparing a single core count against single core
+if len(core_count_range) == 2:
+    print(f"Sweeping {core_count_range[0]} to {core_count_range[1]} Cores")
+    # Looking up every core count in the compile cache, so the workers only simulate the hits
+    core_counts = sorted(set(range(core_count_range[0], core_count_range[1] + 1)) | {1})
+    programs = {}
+    for core_count in core_counts:
+        program = compile_cache.get(compile_cache.key(content, core_count, scheduler))
+        if program is not None:
+            programs[core_count] = program
+    cached = set(programs)
+    if cached:
+        print(f"Loaded compiled code of {len(cached)} core counts from the compile cache")
+    sweep = sweep_core_counts(IR, load_mem(memory_file_name), core_counts, scheduler=scheduler, programs=programs)
+    for core_count, program in programs.items():
+        if core_count not in cached:
+            compile_cache.put(compile_cache.key(content, core_count, scheduler), program)
+    print(f"{'Cores':>5} {'Cycles':>8} {'Speed Up':>9} {'Efficiency':>11} {'NOP Ratio':>10} {'Correct':>8}")
+    for result in sweep:
+        print(f"{result['cores']:>5} {result['cycles']:>8} {result['speed_up']:>9} {result['efficiency']:>11} {result['nop_ratio']:>10} {str(result['correct']):>8}")
+    with open(output_folder + "sweep.json", "w") as handler:
+        json.dump(sweep, handler, indent=4)
+    print(f"Wrote sweep results to '{output_folder}sweep.json'")
+    sys.exit()
+
 # Initializing Code Generator Class for single core and multi-core
-single_core_code_gen = CodeGen(1, path=single_core_code_path)
-multi_core_code_gen = CodeGen(multi_core_count, path=multi_core_code_path)
+single_core_code_gen = CodeGen(1, path=single_core_code_path, scheduler=scheduler)
+multi_core_code_gen = CodeGen(multi_core_count, path=multi_core_code_path, scheduler=scheduler)
+
+# Compiles the IR, reusing the compiled program from the compile cache when one exists
+def compile_program(code_gen, core_count):
+    program_key = compile_cache.key(content, core_count, scheduler)
+    program = compile_cache.get(program_key) if profiler is None else None
+    if program is None:
+        if profiler:
+            code_gen.add_hook(profiler)
+        program = code_gen.generate_compiled_code(IR)
+        compile_cache.put(program_key, program)
+    else:
+        print(f"Loaded compiled code from the compile cache. Makespan: {program.makespan} cycles")
+        code_gen.export_compiled_code(program)
+    return program
 
 # Running Code Generation for single core
 print("Running Single Core Code Generation")
-single_core_code_gen.generate_compiled_code(IR)
+single_core_program = compile_program(single_core_code_gen, 1)
 print()
 
 # Running Code Generation for multi-core
 print("Running Multi Core Code Generation")
-multi_core_code_gen.generate_compiled_code(IR)
+multi_core_program = compile_program(multi_core_code_gen, multi_core_count)
 print("\n\n\n")
 
+if profiler:
+    write_profile()
+
+# Prints the performance counters of a simulation
+def print_counters(counters):
+    print(f"Performance Counters: {counters['cycles']} cycles, {counters['ideal_cycles']} ideal cycles (critical path)")
+    for pe, pe_counters in enumerate(counters['pes']):
+        busy = ", ".join(f"{name} {count}" for name, count in pe_counters['busy_cycles'].items())
+        print(f"PE_{pe}: busy {sum(pe_counters['busy_cycles'].values())} ({busy}), stall {pe_counters['stall_cycles']} (remote {pe_counters['remote_stall_cycles']}, latency {pe_counters['latency_stall_cycles']}, unit {pe_counters['unit_stall_cycles']}), idle {pe_counters['idle_cycles']}, retired {pe_counters['retired']}")
+
 # Initializing Simulators for single core and multi-core
 single_core_simulator = Simulator(1, single_core_code_path)
 multi_core_simulator = Simulator(multi_core_count, multi_core_code_path)
@@ -71,18 +166,20 @@ print("Added Address Value Pairs to Memory")
 print("Simulating Single Core Code")
 print(f'Intial Single Core Memory:', single_core_simulator.MEM)
 print('"""')
-final_single_core_cycle = single_core_simulator.run()
+final_single_core_cycle = single_core_simulator.run(single_core_program)
 print('"""')
 print(f'Final Single Core Memory:', single_core_simulator.MEM)
+print_counters(single_core_simulator.counters)
 print("\n\n")
 
 # Simulating Multi Core Code
 print("Simulating Multi Core Code")
 print(f'Intial Multi Core Memory:', multi_core_simulator.MEM)
 print('"""')
-final_multi_core_cycle = multi_core_simulator.run()
+final_multi_core_cycle = multi_core_simulator.run(multi_core_program)
 print('"""')
 print(f'Final Multi Core Memory:', multi_core_simulator.MEM)
+print_counters(multi_core_simulator.counters)
 print()
 
 print(f"Final Cycle Count: Single Core {final_single_core_cycle}, Multi-Core {final_multi_core_cycle}. Speed Up {round(final_single_core_cycle/final_multi_core_cycle,3)}")
@@ -94,3 +191,7 @@ else:
     print(f'Single Core and Multi Core Memory Not Equal! Code ran incorrectly.')
     print(f'Final Single Core Memory:', single_core_simulator.MEM)
     print(f'Final Multi Core Memory:', multi_core_simulator.MEM)
+
+# Writing the performance counters of both simulations
+with open(output_folder + "counters.json", "w") as handler:
+    json.dump({"single_core": single_core_simulator.counters, "multi_core": multi_core_simulator.counters}, handler, indent=4)
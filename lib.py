@@ -1,22 +1,43 @@
-from graphviz import Digraph
 from pprint import pprint
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from itertools import repeat
 from time import sleep
+import hashlib
+import io
+import heapq
 import math
-import copy
+import mmap
+import operator
 import json
 import os
+import pickle
+import queue
+import random
+import struct
+import time
+import tracemalloc
+import threading
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 input_folder = "input/"
 output_folder = "output/"
 single_core_code_path=output_folder+"single_core_code/"
 multi_core_code_path=output_folder+"multi_core_code/"
+cache_folder=output_folder+"cache/"
 
-#Checks to see if required folders exist
-for folder_path in [input_folder,output_folder,single_core_code_path,multi_core_code_path]:
-    if not (os.path.exists(folder_path) and os.path.isdir(folder_path)):
-        print(f"Creating Folder '{folder_path}' as it does not exist!")
-        os.makedirs(folder_path)
-print("\n\n")
+#Checks to see if required folders exist. Called by execute.py, so importing lib has no side effects
+def create_folders():
+    for folder_path in [input_folder,output_folder,single_core_code_path,multi_core_code_path]:
+        if not (os.path.exists(folder_path) and os.path.isdir(folder_path)):
+            print(f"Creating Folder '{folder_path}' as it does not exist!")
+            os.makedirs(folder_path)
+    print("\n\n")
 
 
 #Checks if a number is a Float or Int
@@ -70,6 +91,346 @@ def load_mem(file_name):
         mem_output.append(to_mem)
     return mem_output
 
+def load_mem_batch(path):
+    """
+    Input: directory of memory files, or CSV file of memory images
+    Output: list of addresses, and matrix of values with one row per address and one column (lane) per memory image
+
+    A directory is read file by file in name order with load_mem(), and every file must hold the same addresses.
+    A CSV file has a header row of addresses followed by one row of values per memory image.
+    Example CSV:
+        x,y,z
+        10,20,30
+        1,2,3
+
+    Args:
+        path (str): Directory of memory files or CSV file name.
+
+    Returns:
+        tuple: List of addresses, and NumPy matrix of values.
+    """
+    if np is None:
+        raise(ImportError("NumPy is required to load a batch of memory images."))
+
+    if os.path.isdir(path):
+        file_names = sorted(os.listdir(path))
+        images = [dict(load_mem(os.path.join(path, file_name))) for file_name in file_names]
+        if not images:
+            raise(ValueError(f"Error! '{path}' does not contain any memory files."))
+        addresses = list(images[0])
+        for file_name, image in zip(file_names, images):
+            if set(image) != set(addresses):
+                raise(ValueError(f"Error! '{file_name}' has addresses {sorted(image)}, expected {sorted(addresses)}."))
+        values = np.array([[image[address] for image in images] for address in addresses], dtype=float)
+    else:
+        with open(path, "r") as handler:
+            rows = [line.strip().replace(" ","").split(",") for line in handler if line.strip()]
+        if not rows:
+            raise(ValueError(f"Error! '{path}' is empty."))
+        addresses = rows[0]
+        for row in rows[1:]:
+            if len(row) != len(addresses):
+                raise(ValueError(f"Error! '{','.join(row)}' does not have a value for each address {addresses}."))
+            for value in row:
+                if not is_number(value):
+                    raise(ValueError(f"Error! value'{value}' is not a float or int!"))
+        values = np.array([[float(value) for value in row] for row in rows[1:]], dtype=float).T.reshape(len(addresses), len(rows)-1)
+    return addresses, values
+
+def load_latency_table(file_name):
+    """
+    Input: file_name of the operation latency table
+    Output: latency, issue cycles and functional units of each operation, and the forwarding latency between PEs
+
+    Each operation maps either to its latency in cycles, such as "MUL":4, which holds the PE that issues it
+    for the whole latency, or to a pipelined functional unit, such as "MUL":{"latency":4, "interval":1, "units":2}.
+    A pipelined operation's result is ready latency cycles after it issues, each of the PE's units of it accepts
+    a new operation every interval cycles (the latency by default), and the PE issues its next instruction on the next cycle.
+    The optional "FORWARD" entry is the number of extra cycles a result takes to reach other PEs, 0 by default.
+
+    Args:
+        file_name (str): Name of the latency table, such as 'operation_latency.json'.
+
+    Returns:
+        tuple: Dicts of each operation's latency, cycles its PE is held for after issuing it,
+            and (unit count, issue interval) of its functional units, and the forwarding latency.
+    """
+    with open(file_name, 'r') as f:
+        table = json.load(f)
+
+    forward_latency = table.pop("FORWARD", 0)
+    if forward_latency < 0:
+        raise(ValueError(f"Error! 'FORWARD' in '{file_name}' can not be negative."))
+    cycle_times, issue_cycles, units = {}, {}, {}
+    for name, entry in table.items():
+        if isinstance(entry, dict):
+            latency = entry["latency"]
+            interval = entry.get("interval", latency)
+            count = entry.get("units", 1)
+            issue_cycles[name] = 1
+        else:
+            latency = interval = issue_cycles[name] = entry
+            count = 1
+        if min(latency, interval, count) < 1:
+            raise(ValueError(f"Error! '{name}' in '{file_name}' needs a latency, interval and units of at least 1."))
+        cycle_times[name] = latency
+        units[name] = (count, interval)
+    return cycle_times, issue_cycles, units, forward_latency
+
+def default_scheduler(forward_latency):
+    """
+    Picks the CodeGen scheduler used when none is given. The balancing scheduler places tasks by workload only,
+    so once results take extra cycles to reach other PEs the communication-aware critical path scheduler is used.
+
+    Args:
+        forward_latency (int): The forwarding latency from load_latency_table().
+
+    Returns:
+        str: "critical_path" when the forwarding latency is above 0, otherwise "balance".
+    """
+    return "critical_path" if forward_latency > 0 else "balance"
+
+def generate_program(num_instructions, width=4, reuse=0.2, const_density=0.2, dead_fraction=0.1, num_addresses=4, seed=0):
+    """
+    Generates a random valid program, for benchmarks and tests that need more than 'input/code.txt'.
+    The program runs `width` dependency chains side by side, each starting with a LOAD and ending with a STORE,
+    so the depth of the DAG is about num_instructions/width. Inputs are read from addresses 'x0', 'x1', ...
+    and results are stored to fresh addresses 'y0', 'y1', ... so no two STOREs write the same address.
+    Divisors are always non-zero constants and SQRT only takes values that cannot be negative,
+    so the program simulates without errors for non-negative inputs.
+
+    Args:
+        num_instructions (int): Approximate number of instructions in the program.
+        width (int, optional): Number of dependency chains. Defaults to 4.
+        reuse (float, optional): Probability that an operand is an earlier value of any chain,
+            which joins chains into a DAG. Defaults to 0.2.
+        const_density (float, optional): Probability that an operand is a constant. Defaults to 0.2.
+        dead_fraction (float, optional): Fraction of instructions whose results are never used. Defaults to 0.1.
+        num_addresses (int, optional): Number of input addresses. Defaults to 4.
+        seed (int, optional): Random seed. Defaults to 0.
+
+    Returns:
+        str: The program, one instruction per line.
+    """
+    rand = random.Random(seed)
+    lines = []
+    values = []             #Registers that later instructions may read
+    non_negative = set()    #Registers whose value cannot be negative
+    register_count = 0
+    store_count = 0
+
+    def new_register():
+        nonlocal register_count
+        register_count += 1
+        return f"t{register_count}"
+
+    def constant():
+        return str(rand.randint(1, 9))
+
+    chains = []
+    for chain in range(width):
+        register = new_register()
+        lines.append(f"{register}=LOAD(x{chain % num_addresses});")
+        non_negative.add(register)
+        values.append(register)
+        chains.append(register)
+    last_non_negative = chains[-1]
+
+    while len(lines) < num_instructions - width:
+        chain = rand.randrange(width)
+        register = new_register()
+        operand = chains[chain]
+        kind = rand.random()
+
+        if kind < 0.04:
+            lines.append(f"{register}=LOAD(x{rand.randrange(num_addresses)});")
+            non_negative.add(register)
+        elif kind < 0.07:
+            #Stores a chain's value midway, which LOADs never read back
+            lines.append(f"STORE(y{store_count} , {operand} );")
+            store_count += 1
+            continue
+        elif kind < 0.17:
+            if operand not in non_negative:
+                operand = last_non_negative
+            lines.append(f"{register}=^{operand};")
+            non_negative.add(register)
+        else:
+            operation = rand.choice("+-*/")
+            if operation == "/" or rand.random() < const_density:
+                other = constant()
+            elif rand.random() < reuse:
+                other = rand.choice(values)
+            else:
+                other = operand
+            if operation != "/" and rand.random() < 0.5:
+                operand, other = other, operand
+            lines.append(f"{register}={operand}{operation}{other};")
+            if operation != "-" and all(token in non_negative or token.isdigit() for token in (operand, other)):
+                non_negative.add(register)
+
+        if register in non_negative:
+            last_non_negative = register
+        if rand.random() >= dead_fraction:
+            values.append(register)
+            chains[chain] = register
+
+    for chain in range(width):
+        lines.append(f"STORE(y{store_count} , {chains[chain]} );")
+        store_count += 1
+    return "\n".join(lines)
+
+#Integer opcode of each operation in the binary compiled code format and binary traces
+OPCODES = ["NOP", "LOAD", "STORE", "EQ", "ADD", "SUB", "MUL", "DIV", "SQRT", "FMA"]
+OPCODE_IDS = {name: idx for idx, name in enumerate(OPCODES)}
+
+#Simulation trace levels: nothing, a summary after the run, a line per issued instruction, or a line per cycle
+TRACE_OFF, TRACE_SUMMARY, TRACE_INSTRUCTION, TRACE_CYCLE = range(4)
+
+def run_phase(hooks, name, function, *args):
+    """
+    Runs one phase of the compiler pipeline, telling every hook before and after it runs.
+
+    Args:
+        hooks (list): Objects with before(name, args) and after(name, result) methods, such as a Profiler.
+        name (str): Name of the phase.
+        function (function): The phase.
+        *args: Arguments passed to the phase.
+
+    Returns:
+        object: The result of the phase.
+    """
+    if not hooks:
+        return function(*args)
+    for hook in hooks:
+        hook.before(name, args)
+    result = function(*args)
+    for hook in reversed(hooks):
+        hook.after(name, result)
+    return result
+
+class Profiler():
+    """
+    A hook for Parser and CodeGen that records the wall time, call count, smallest and largest size before and after,
+    and peak memory of every phase of the compiler pipeline. Phases may nest, such as the rebalancing iterations inside
+    balance_workload, and the time and peak memory of a phase include its nested phases.
+    """
+    def __init__(self, trace_memory=True) -> None:
+        """
+        Initializes the Profiler.
+
+        Args:
+            trace_memory (bool, optional): Record the peak memory of each phase with tracemalloc,
+                which slows down the pipeline. Defaults to True.
+        """
+        self.trace_memory = trace_memory
+        self.phases = {}
+        self._stack = []
+        self._started_tracemalloc = False
+
+    def before(self, name, args):
+        """
+        Starts timing a phase.
+
+        Args:
+            name (str): Name of the phase.
+            args (tuple): Arguments of the phase. The size of the first one is recorded.
+        """
+        memory = 0
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracemalloc = True
+            memory, peak = tracemalloc.get_traced_memory()
+            #The enclosing phase keeps its peak so far, since the peak is reset for this phase
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+        self._stack.append({"name": name, "size": self._size(args[0]) if args else None,
+                            "memory": memory, "peak": memory, "start": time.perf_counter()})
+
+    def after(self, name, result):
+        """
+        Stops timing a phase and adds it to the phase's record.
+
+        Args:
+            name (str): Name of the phase.
+            result (object): Result of the phase, whose size is recorded.
+        """
+        wall_time = time.perf_counter()
+        frame = self._stack.pop()
+        wall_time -= frame["start"]
+        peak = 0
+        if self.trace_memory:
+            frame["peak"] = max(frame["peak"], tracemalloc.get_traced_memory()[1])
+            peak = frame["peak"] - frame["memory"]
+            if self._stack:
+                self._stack[-1]["peak"] = max(self._stack[-1]["peak"], frame["peak"])
+
+        record = self.phases.setdefault(name, {"calls": 0, "wall_time": 0.0, "size_before": None,
+                                               "size_after": None, "peak_memory": 0})
+        record["calls"] += 1
+        record["wall_time"] += wall_time
+        #A phase called several times, such as the dependency analysis after each pass, sees different sizes
+        record["size_before"] = self._size_range(record["size_before"], frame["size"])
+        record["size_after"] = self._size_range(record["size_after"], self._size(result))
+        record["peak_memory"] = max(record["peak_memory"], peak)
+
+    def stop(self):
+        """
+        Stops tracemalloc if the Profiler started it.
+        """
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+            self._started_tracemalloc = False
+
+    def report(self):
+        """
+        Gets the recorded phases in the order they first finished.
+
+        Returns:
+            dict: For each phase its call count, total wall time in seconds, smallest and largest size of its input
+                and of its output over its calls as [min, max] (None when they have no size), and peak memory in bytes.
+        """
+        return {name: dict(record, wall_time=round(record["wall_time"], 6)) for name, record in self.phases.items()}
+
+    def _size_range(self, size_range, size):
+        """
+        Widens the smallest and largest size of a phase's input or output over its calls with the size of one call.
+
+        Args:
+            size_range (list): [min, max] of the earlier calls, or None.
+            size (int): Size of this call, or None when it has no size.
+
+        Returns:
+            list: The widened [min, max], or None when no call had a size.
+        """
+        if size is None:
+            return size_range
+        if size_range is None:
+            return [size, size]
+        return [min(size_range[0], size), max(size_range[1], size)]
+
+    def _size(self, value):
+        """
+        Measures the input or output of a phase: the number of instructions, tasks or tokens it holds.
+
+        Args:
+            value (object): The input or output. For a tuple, its first item is measured.
+
+        Returns:
+            int: The size, or None when the value has no size.
+        """
+        if isinstance(value, tuple) and value:
+            value = value[0]
+        if isinstance(value, CompiledProgram):
+            return sum(len(pe_code) for pe_code in value.pe_code)
+        if isinstance(value, list) and value and all(isinstance(item, list) for item in value):
+            return sum(len(item) for item in value)
+        if isinstance(value, list):
+            return len(value)
+        return None
+
 class Parser():
     """
     A class that parses an inputted code and generates an optimized IR.
@@ -82,7 +443,8 @@ class Parser():
         - delims: List of delimiters.
         - symbol_to_name: Dictionary mapping operators to their corresponding names.
         - operator_map: Dictionary mapping operator names to their corresponding symbols.
-        - dot: Graphviz Digraph object for visualizing the data flow graph.
+        - dot: Graphviz Digraph object for visualizing the data flow graph, created when the DFG is rendered.
+        - hooks: Objects told before and after every phase of parse(), such as a Profiler.
         """
         self.operators = ["*","/","+","-","^"]
         self.delims = [" ", "(",")","="]
@@ -97,7 +459,17 @@ class Parser():
                 'MUL': '*',
                 'DIV': '/',
             }
-        self.dot = Digraph()
+        self.dot = None
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """
+        Adds a hook told before and after every phase of parse(), such as a Profiler.
+
+        Args:
+            hook (object): Object with before(name, args) and after(name, result) methods.
+        """
+        self.hooks.append(hook)
     
     def _gen_tokenized_list(self,instructions):
         """
@@ -175,7 +547,7 @@ class Parser():
 
     def _gen_dependencies(self,IR):
         """
-        Generates Read-after-Write (RAW) and Write-after-read (WAR) dependencies from a partial IR.
+        Generates Read-after-Write (RAW), Write-after-read (WAR) and Write-after-Write (WAW) dependencies from a partial IR.
 
         Args:
             IR (list): Partial IR.
@@ -187,33 +559,34 @@ class Parser():
         write_depend, read_depend = [], [] #Pos of WAR, and RAW in list
         edges = []
 
-        for instr in IR:
+        #Index of the last instruction writing each register, and of every
+        #instruction that has read each register, so each lookup is O(1).
+        last_writer = {}
+        readers = {}
+
+        for pos, instr in enumerate(IR):
             depend_tokens = []
             depend_tokens_pos = []
             #Check Read Dependicies
             for token in  instr[2:]:
-                #print(token,instr[2:],indep)  
-                for pos, dep_token in reversed(list(enumerate(RAW))):
-                    if token == dep_token:
-                        if token not in depend_tokens: 
-                            depend_tokens.append(token)
-                            depend_tokens_pos.append(pos)
-                        break
-                    
-            #Check Write Dependicies
-            token = instr[1]
-            read_tokens = []
-            read_tokens_pos = []
-            for pos , tokens in  enumerate(WAR):
-                if token in tokens:
-                    read_tokens.append(token)
-                    read_tokens_pos.append(pos)
+                if token in last_writer and token not in depend_tokens:
+                    depend_tokens.append(token)
+                    depend_tokens_pos.append(last_writer[token])
 
+            #Check Write Dependicies, on earlier readers (WAR) and the earlier writer (WAW)
+            read_tokens_pos = readers.get(instr[1], [])
+            if instr[1] in last_writer:
+                read_tokens_pos = read_tokens_pos + [last_writer[instr[1]]]
 
             read_depend.append(tuple(set(read_tokens_pos)))
             RAW.append('' if instr[1] == "STORE" else instr[1])
-  
+            last_writer[RAW[-1]] = pos
+
             WAR.append(depend_tokens)
+            #Every read counts, including addresses no earlier STORE wrote
+            for token in set(instr[2:]):
+                if not is_number(token):
+                    readers.setdefault(token, []).append(pos)
             write_depend.append(tuple(set(depend_tokens_pos)))
 
         for x, ys in enumerate(write_depend):
@@ -245,6 +618,316 @@ class Parser():
 
         return new_partial_IR
 
+    def _value_numbering(self, IR):
+        """
+        Removes instructions that recompute an already computed value (Global Value Numbering).
+        Every register and constant is given a value number, and each instruction is hashed by its
+        operation and operand value numbers, with ADD and MUL operands sorted so 't1*t2' and 't2*t1' match.
+        Later reads of a removed instruction's register are rewired to the register holding the first computation.
+        Example: 'MUL t5, t1, t2','MUL t6, t2, t1','ADD t7, t6, 1' becomes 'MUL t5, t1, t2','ADD t7, t5, 1'
+
+        Args:
+            IR (list): Partial IR.
+
+        Returns:
+            list: New partial IR without recomputed values.
+        """
+        #Position of the next instruction that writes the same register.
+        next_def = [len(IR)] * len(IR)
+        last_def = {}
+        for idx in reversed(range(len(IR))):
+            next_def[idx] = last_def.get(IR[idx][1], len(IR))
+            last_def[IR[idx][1]] = idx
+
+        value_numbers = {}
+        def value_number(key):
+            if key not in value_numbers:
+                value_numbers[key] = len(value_numbers)
+            return value_numbers[key]
+
+        reg_value = {}      #Value number currently held by each register
+        def_pos = {}        #Position of the instruction that defined each register
+        holder = {}         #Register holding each computed value number
+        alias = {}          #Register to read instead of a removed instruction's register
+        mem_version = {}    #Position of the last store to each memory address
+        mem_value = {}      #Value number currently held by each memory address
+
+        def operand_value(token):
+            if token in reg_value:
+                return reg_value[token]
+            return value_number(('CONST', token) if is_number(token) else ('REG', token))
+
+        new_partial_IR = []
+        for idx, instruction in enumerate(IR):
+            name, dst = instruction[0], instruction[1]
+
+            if name == "STORE":
+                src = alias.get(instruction[2], instruction[2])
+                #Address 'dst' already holds the value.
+                if mem_value.get(dst) == operand_value(src):
+                    continue
+                new_partial_IR.append((name, dst, src))
+                mem_version[dst] = idx
+                mem_value[dst] = operand_value(src)
+                continue
+
+            if name == "LOAD":
+                srcs = [instruction[2]]
+                key = (name, instruction[2], mem_version.get(instruction[2]))
+            else:
+                srcs = [alias.get(token, token) for token in instruction[2:]]
+                operands = [operand_value(token) for token in srcs]
+                if name in ["ADD", "MUL"]:
+                    operands.sort()
+                key = (name, *operands)
+
+            #Register 'dst' is redefined here, so earlier aliases of it no longer apply.
+            alias.pop(dst, None)
+
+            vn = value_number(key)
+            reg = holder.get(vn)
+            if reg is not None and reg_value.get(reg) == vn:
+                #'dst' already holds the value.
+                if reg == dst:
+                    def_pos[dst] = idx
+                    continue
+                #'reg' is not redefined before the last read of 'dst'.
+                if next_def[def_pos[reg]] >= next_def[idx]:
+                    alias[dst] = reg
+                    continue
+
+            new_partial_IR.append((name, dst, *srcs))
+            if name == "LOAD":
+                mem_value[instruction[2]] = vn
+            reg_value[dst] = vn
+            def_pos[dst] = idx
+            holder[vn] = dst
+
+        return new_partial_IR
+
+    def _rename_registers(self, IR):
+        """
+        Renames registers so every register is written by exactly one instruction (SSA form).
+        A register keeps its name for its first definition, later definitions get a numbered version,
+        and reads are rewired to the version live at that point. Redefining a register then no longer
+        has to wait for earlier readers (WAR) or writers (WAW), so only true data dependencies remain.
+        A version number already taken by a register of the program, such as 't4_1', is skipped.
+        Example: 'SQRT t4, t4','ADD t3, t4, t3' becomes 'SQRT t4_1, t4','ADD t3_1, t4_1, t3'
+
+        Args:
+            IR (list): Partial IR.
+
+        Returns:
+            list: New partial IR with a single definition per register.
+        """
+        current = {}        #Name of the live version of each register
+        versions = {}       #Number of versions of each register so far
+        #Every register name of the program, so a new version never takes a name already in use
+        taken = {token for instruction in IR for token in
+                 ([instruction[2]] if instruction[0] == "STORE" else instruction[1:2] if instruction[0] == "LOAD" else instruction[1:])
+                 if not is_number(token)}
+
+        new_partial_IR = []
+        for instruction in IR:
+            name, dst = instruction[0], instruction[1]
+            if name == "STORE":
+                new_partial_IR.append((name, dst, current.get(instruction[2], instruction[2])))
+                continue
+
+            #LOAD reads a memory address, not a register
+            srcs = instruction[2:] if name == "LOAD" else [current.get(token, token) for token in instruction[2:]]
+            if dst in versions:
+                versions[dst] += 1
+                while f"{dst}_{versions[dst]}" in taken:
+                    versions[dst] += 1
+                current[dst] = f"{dst}_{versions[dst]}"
+                taken.add(current[dst])
+            else:
+                versions[dst] = 0
+                current[dst] = dst
+            new_partial_IR.append((name, current[dst], *srcs))
+
+        return new_partial_IR
+
+    def _reassociate(self, IR):
+        """
+        Reduces the height of ADD and MUL chains by reassociating them into balanced trees (tree-height reduction).
+        A tree is an ADD or MUL whose operands are results of the same operation read nowhere else.
+        Its leaves are combined two at a time, always taking the two that are ready earliest, with constant leaves
+        folded together first, and the tree is only rewritten when that lowers its height.
+        Reassociation changes floating-point rounding, so it is opt-in and needs renamed (SSA) registers.
+        Example: 'ADD t3, t1, t2','ADD t4, t3, t5','ADD t6, t4, t7' becomes 'ADD t3, t1, t2','ADD t4, t5, t7','ADD t6, t3, t4'
+
+        Args:
+            IR (list): Partial IR, with every register written once.
+
+        Returns:
+            list: New partial IR with balanced ADD and MUL trees.
+        """
+        definition = {instruction[1]: instruction for instruction in IR if instruction[0] != "STORE"}
+        uses = {}
+        for instruction in IR:
+            for token in (instruction[2:] if instruction[0] != "LOAD" else []):
+                uses[token] = uses.get(token, 0) + 1
+
+        #An interior node is read once, by an instruction of the same operation
+        interior = set()
+        for instruction in IR:
+            if instruction[0] in ["ADD", "MUL"]:
+                for token in instruction[2:]:
+                    if uses.get(token) == 1 and definition.get(token, ("",))[0] == instruction[0]:
+                        interior.add(token)
+
+        #The trees are walked with explicit stacks, since long chains are deeper than the recursion limit
+        def leaves(register):
+            tokens = []
+            stack = list(reversed(definition[register][2:]))
+            while stack:
+                token = stack.pop()
+                if token in interior:
+                    stack.extend(reversed(definition[token][2:]))
+                else:
+                    tokens.append(token)
+            return tokens
+
+        def nodes(register):
+            order = []
+            stack = [(register, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if expanded:
+                    order.append(node)
+                    continue
+                stack.append((node, True))
+                stack.extend((token, False) for token in reversed(definition[node][2:]) if token in interior)
+            return order
+
+        height = {}     #Number of operations on the longest path to each register
+        def operand_height(token):
+            return height.get(token, 0)
+
+        def tree_height(register):
+            tree = {}
+            for node in nodes(register):
+                tree[node] = 1 + max(tree[token] if token in interior else operand_height(token) for token in definition[node][2:])
+            return tree[register]
+
+        new_partial_IR = []
+        for instruction in IR:
+            name, dst = instruction[0], instruction[1]
+            if dst in interior and name != "STORE":
+                continue
+            if name not in ["ADD", "MUL"] or not any(token in interior for token in instruction[2:]):
+                new_partial_IR.append(instruction)
+                if name != "STORE":
+                    height[dst] = 1 + max((operand_height(token) for token in instruction[2:]), default=0) if name != "LOAD" else 1
+                continue
+
+            operands = leaves(dst)
+            constants = [token for token in operands if is_number(token)]
+            registers = [token for token in operands if not is_number(token)]
+            while len(constants) > 1:
+                constants.append(self._fold_instruction((name, "", constants.pop(), constants.pop()))[2])
+
+            #Combine the two earliest ready operands, reusing the tree's registers for the intermediate results
+            names = [node for node in nodes(dst) if node != dst]
+            ready = [(operand_height(token), order, token) for order, token in enumerate(constants + registers)]
+            heapq.heapify(ready)
+            balanced = []
+            while len(ready) > 1:
+                left_height, _, left = heapq.heappop(ready)
+                right_height, order, right = heapq.heappop(ready)
+                register = names.pop(0) if len(ready) else dst
+                balanced.append((name, register, left, right))
+                heapq.heappush(ready, (max(left_height, right_height) + 1, order, register))
+
+            if ready[0][0] < tree_height(dst):
+                for new_instruction in balanced:
+                    new_partial_IR.append(new_instruction)
+                    height[new_instruction[1]] = 1 + max(operand_height(token) for token in new_instruction[2:])
+            else:
+                for node in nodes(dst):
+                    new_partial_IR.append(definition[node])
+                    height[node] = 1 + max(operand_height(token) for token in definition[node][2:])
+
+        return new_partial_IR
+
+    def _strength_reduction(self, IR, fma=False, inexact=False):
+        """
+        Replaces operations with cheaper ones, using the cycle times in 'operation_latency.json'.
+        Example: 'DIV t5, t1, 2' becomes 'MUL t5, t1, 0.5' when MUL is faster than DIV,
+        and 'MUL t4, t1, 2' becomes 'ADD t4, t1, t1' when ADD is faster than MUL.
+        With fma, a MUL read only by an ADD is fused into it, such as 'MUL t9, t5, t2','ADD t3, t9, t4' becoming
+        'FMA t3, t5, t2, t4', when FMA is cheaper than MUL plus ADD and does not lengthen the path to the result.
+        The IR is unchanged when there is no 'operation_latency.json'.
+
+        Args:
+            IR (list): Partial IR. With fma, every register must be written once.
+            fma (bool, optional): Fuse MUL and ADD into FMA. Defaults to False.
+            inexact (bool, optional): Also replace divisions by constants whose reciprocal rounds. Defaults to False.
+
+        Returns:
+            list: New partial IR with cheaper operations.
+        """
+        if not os.path.isfile(input_folder+'operation_latency.json'):
+            return IR
+        cost = load_latency_table(input_folder+'operation_latency.json')[0]
+
+        new_partial_IR = []
+        for instruction in IR:
+            name = instruction[0]
+            if name == "DIV" and is_number(instruction[3]) and cost["MUL"] < cost["DIV"]:
+                divisor = float(instruction[3])
+                #Dividing by a power of two and multiplying by its reciprocal give identical results
+                if divisor != 0 and (inexact or math.frexp(abs(divisor))[0] == 0.5):
+                    instruction = ("MUL", instruction[1], instruction[2], repr(1 / divisor))
+            elif name == "MUL" and cost["ADD"] < cost["MUL"]:
+                operands = [token for token in instruction[2:] if not (is_number(token) and float(token) == 2)]
+                if len(operands) == 1 and not is_number(operands[0]):
+                    instruction = ("ADD", instruction[1], operands[0], operands[0])
+            new_partial_IR.append(instruction)
+
+        if not fma or "FMA" not in cost or cost["FMA"] >= cost["MUL"] + cost["ADD"]:
+            return new_partial_IR
+
+        definition = {instruction[1]: instruction for instruction in new_partial_IR if instruction[0] != "STORE"}
+        uses = {}
+        for instruction in new_partial_IR:
+            for token in (instruction[2:] if instruction[0] != "LOAD" else []):
+                uses[token] = uses.get(token, 0) + 1
+
+        #Cycle each register's value is ready at when only data dependencies delay it
+        ready = {}
+        fused = {}      #ADD register -> MUL register fused into it
+        for instruction in new_partial_IR:
+            name, dst = instruction[0], instruction[1]
+            if name == "STORE":
+                continue
+            sources = [] if name == "LOAD" else instruction[2:]
+            ready[dst] = max((ready.get(token, 0) for token in sources), default=0) + cost[name]
+            if name != "ADD":
+                continue
+            for product, addend in [instruction[2:4], instruction[3:1:-1]]:
+                if uses.get(product) == 1 and definition.get(product, ("",))[0] == "MUL":
+                    factors = definition[product][2:]
+                    fused_ready = max([ready.get(token, 0) for token in factors] + [ready.get(addend, 0)]) + cost["FMA"]
+                    if fused_ready <= ready[dst]:
+                        fused[dst] = product
+                        ready[dst] = fused_ready
+                        break
+
+        products = set(fused.values())
+        fused_IR = []
+        for instruction in new_partial_IR:
+            if instruction[0] == "MUL" and instruction[1] in products:
+                continue
+            if instruction[0] == "ADD" and instruction[1] in fused:
+                product = fused[instruction[1]]
+                addend = instruction[3] if instruction[2] == product else instruction[2]
+                instruction = ("FMA", instruction[1], *definition[product][2:], addend)
+            fused_IR.append(instruction)
+        return fused_IR
+
     def _dead_code_removal(self, IR, write_depend, instructions):
         """
         Removes dead code from the IR.
@@ -260,29 +943,24 @@ class Parser():
         """
 
 
-        instructions_keep = set()
         store_instructions_pos = []
         for idx, instrc in enumerate(IR):
             if instrc[0] == "STORE":
                 store_instructions_pos.append(idx)
-        
-        #Helper function to find which instructions are part 
-        #of the dependency chain to a store instruction.
-        def dfs(idx):
-    
-            if len(write_depend[idx]) ==0 or IR[idx][0] == "LOAD":
-                instructions_keep.add(idx)
-                return True
-            results = False
-            for pos in write_depend[idx]:
-                if dfs(pos):
-                    results = True or results
-            if results:
-                instructions_keep.add(idx)
-            return results
 
-        for instrc_idx in store_instructions_pos:
-            dfs(instrc_idx)
+        #Single reverse reachability sweep from every store instruction to find
+        #which instructions are part of its dependency chain. Each instruction
+        #is visited at most once, and loads end the chain.
+        instructions_keep = set(store_instructions_pos)
+        stack = list(store_instructions_pos)
+        while stack:
+            idx = stack.pop()
+            if IR[idx][0] == "LOAD":
+                continue
+            for pos in write_depend[idx]:
+                if pos not in instructions_keep:
+                    instructions_keep.add(pos)
+                    stack.append(pos)
 
         new_IR_Partial, new_instructions = [], []
         for idx, instruction in enumerate(IR):
@@ -292,81 +970,73 @@ class Parser():
 
         return new_instructions, new_IR_Partial
 
-    def _constant_folding(self,IR):
+    def _fold_instruction(self, instruction):
         """
-        Applies constant folding to instructions that have constants as their read registers.
+        Applies constant folding to an instruction that has constants as its read registers.
         Example: 'ADD t1, 1, 1' becomes 'EQ, t1, 2' 
 
         Args:
-            IR (list): IR.
+            instruction (tuple): Partial IR instruction.
 
         Returns:
-            list: New partial IR.
+            tuple: Folded 'EQ' instruction, or the unchanged instruction if it can not be folded.
         """
-        for idx, instruction in enumerate(IR):
-            if instruction[0] in self.symbol_to_name.values():
-                if instruction[0] == "SQRT":
-                    if is_number(instruction[2]):
-                        IR[idx] = ('EQ', instruction[1], str(math.sqrt(float(instruction[2]))), instruction[3] )   
-                else:
-                    if is_number(instruction[2]) and is_number(instruction[3]):
-                        result = eval(instruction[2]  +  self.operator_map[instruction[0]]  + instruction[3])
-                        IR[idx] = ('EQ', instruction[1], str(result), instruction[4] )
-        return IR 
-
-    def _constant_propogation(self, IR, write_depend):
+        if instruction[0] == "SQRT":
+            if is_number(instruction[2]):
+                return ('EQ', instruction[1], str(math.sqrt(float(instruction[2]))))
+        elif instruction[0] in self.operator_map:
+            if is_number(instruction[2]) and is_number(instruction[3]):
+                result = eval(instruction[2]  +  self.operator_map[instruction[0]]  + instruction[3])
+                return ('EQ', instruction[1], str(result))
+        return instruction
+
+    def _constant_folding_propagation(self, IR, write_depend):
         """
-        Applies constant propagation to instructions that read from instructions that are constant.
-        Example: 'EQ, t1, 1','ADD t1, t1, 2' becomes 'ADD t1, 1, 2'
+        Applies constant folding and constant propagation with a worklist over the def-use graph.
+        Only the users of an instruction are revisited once that instruction becomes constant,
+        and instructions are popped in program order so every producer is final before its users.
+        Example: 'EQ, t1, 1','ADD t2, t1, 2' becomes 'EQ, t2, 3'
 
         Args:
             IR (list): IR.
             write_depend (list): Positions of write dependencies.
 
         Returns:
-            tuple: New partial IR and boolean indicating if any constant folding occurred.
+            list: New partial IR without constant ('EQ') instructions.
         """
-        bool = False
-        for idx, instruction in enumerate(IR):
+        IR = [instruction[:len(instruction)-1] for instruction in IR]
 
-            if instruction[0] == "LOAD":
-                continue
+        users = [[] for _ in IR]
+        for idx, producers in enumerate(write_depend):
+            for pos in producers:
+                users[pos].append(idx)
 
-            value1 = instruction[2]
-            value2 = instruction[3]
-            
-            for pos in write_depend[idx]:
-                if IR[pos][0] != "EQ":
+        worklist = []
+        for idx, instruction in enumerate(IR):
+            IR[idx] = self._fold_instruction(instruction)
+            if IR[idx][0] == "EQ":
+                worklist.append(idx)
+        queued = set(worklist)
+
+        while worklist:
+            idx = heapq.heappop(worklist)
+            constant, value = IR[idx][1], IR[idx][2]
+            for user in users[idx]:
+                instruction = list(IR[user])
+                if instruction[0] == "LOAD":
                     continue
-                constant = IR[pos][1]
-                value = IR[pos][2]
 
                 if instruction[2] == constant:
-                    value1 = value
-                    bool = True
-
-                if instruction[0] not in ["STORE","SQRT"]:
-    
-                    if instruction[3] == constant:
-                        value2 = value
-                        bool = True
-
-            if len(IR[idx]) == 5:
-                IR[idx] = (instruction[0], instruction[1], value1, value2, instruction[4])
-            else:
-                IR[idx] = (instruction[0], instruction[1], value1, instruction[3])
+                    instruction[2] = value
+                if len(instruction) == 4 and instruction[3] == constant:
+                    instruction[3] = value
 
+                IR[user] = self._fold_instruction(tuple(instruction))
+                if IR[user][0] == "EQ" and user not in queued:
+                    queued.add(user)
+                    heapq.heappush(worklist, user)
 
-        new_partial_IR = []
-        for idx, instruction in enumerate(IR):
-            if instruction[0] != "EQ":
-                if len(instruction) == 5:
-                    x = (instruction[0],instruction[1],instruction[2],instruction[3])
-                else:
-                    x = (instruction[0],instruction[1],instruction[2])
-                new_partial_IR.append(x)
-        
-        return  new_partial_IR, bool
+        return [instruction for instruction in IR if instruction[0] != "EQ"]
 
     def _IR_to_instruction(self, IR):
         """
@@ -390,223 +1060,730 @@ class Parser():
                 name = f'{instruction[1]}={instruction[2]}{self.operator_map[instruction[0]]}{instruction[3]}'
             elif instruction[0] in "SQRT": 
                 name = f'{instruction[1]}=^{instruction[2]}'
+            elif instruction[0] == "FMA":
+                name = f'{instruction[1]}={instruction[2]}*{instruction[3]}+{instruction[4]}'
             instructions.append(name)
         return instructions
 
-    def _dfg(self,instructions,edges):
+    def _dfg(self,instructions,edges,render=True):
         """
         Generates a data flow graph from the inputted instruction list and edges.
+        The edge list is written to 'DFG.output', and rendering the SVG image imports graphviz on first use.
+
+        Args:
+            instructions (list): The instructions, as the DFG's nodes.
+            edges (list): The edges between instructions.
+            render (bool, optional): Also render 'DFG_image.svg' with graphviz. Defaults to True.
         """
+        lines = [f"{idx}: {instr}\n" for idx, instr in enumerate(instructions)]
+        lines.extend(f"{x}->{y}\n" for x,y in edges)
+
+        os.makedirs(output_folder, exist_ok=True)
+        with open(output_folder+"DFG.output", "w") as f:
+            f.write("".join(lines))
+
+        if not render:
+            return
+
+        from graphviz import Digraph
         self.dot = Digraph()
-        file_contents = ""
         for idx, instr in enumerate(instructions):
             self.dot.node(str(idx), str(idx)+": "+str(instr))
-            file_contents += f"{idx}: {instr}\n"
-
         for x,y in edges:
             self.dot.edge(str(x),str(y))
-            file_contents += f"{x}->{y}\n"
-        
-        with open(output_folder+"DFG.output", "w") as f:
-            f.write(file_contents)
 
         self.dot.render(output_folder+'DFG_image',format='svg')
 
-    def parse(self,code):
+    def parse(self,code,dfg="render",rename=True,reassociate=False,strength_reduction=False,fma=False):
         """
         Parses the inputted code and generates the intermediate representation (IR), dependencies, write-after-read (WAR)
         dependencies, and write dependencies.
 
         Args:
             code (str): Code to parse.
+            dfg (str, optional): "render" writes the 'DFG.output' edge list and renders 'DFG_image.svg',
+                "output" only writes 'DFG.output', and None skips the DFG. Defaults to "render".
+            rename (bool, optional): Rename registers so each is written once, leaving only true dependencies. Defaults to True.
+            reassociate (bool, optional): Reassociate ADD and MUL chains into balanced trees, allowing floating-point
+                results to round differently. Needs rename. Defaults to False.
+            strength_reduction (bool, optional): Replace operations with cheaper ones from 'operation_latency.json'.
+                Divisions by constants that are not powers of two are only replaced when reassociate is set. A cheaper
+                operation can still lengthen the scheduled makespan by changing the mix of operations on each PE,
+                so this is opt-in. Defaults to False.
+            fma (bool, optional): Also fuse MUL and ADD into FMA when the latency table has an FMA cost.
+                Needs rename and strength_reduction. Defaults to False.
 
         Returns:
             tuple: IR, dependencies, WAR dependencies, and write dependencies.
         """
+        if dfg not in ["render", "output", None]:
+            raise(ValueError(f"Unknown DFG option '{dfg}'. Use 'render', 'output' or None."))
+        if reassociate and not rename:
+            raise(ValueError("Reassociation needs renamed registers. Use rename=True."))
+        if fma and not (rename and strength_reduction):
+            raise(ValueError("FMA fusion needs renamed registers and strength reduction. Use rename=True and strength_reduction=True."))
     
         instructions = [instr.strip("\n") for instr in code.split(";")[:-1]]
+        phase = lambda name, function, *args: run_phase(self.hooks, name, function, *args)
 
         #Tokenize instruction set
-        tokenized_list = self._gen_tokenized_list(instructions)
+        tokenized_list = phase("tokenize", self._gen_tokenized_list, instructions)
         
         #Generates partial IR without dependency list
-        IR_partial = self._gen_partial_IR(tokenized_list)
+        IR_partial = phase("partial_IR", self._gen_partial_IR, tokenized_list)
         
         #Generates IR(with dependencies list)
-        IR, writes, depend, edges, write_depend = self._gen_dependencies(IR_partial)
+        IR, writes, depend, edges, write_depend = phase("dependencies", self._gen_dependencies, IR_partial)
         
         #Remove Duplicate code
-        IR, writes, depend, edges, write_depend = self._gen_dependencies(self._remove_duplicate_code(IR))
+        IR, writes, depend, edges, write_depend = phase("dependencies", self._gen_dependencies, phase("duplicate_removal", self._remove_duplicate_code, IR))
 
         #Handles WAW and insutrctions that have no dependecies
-        instructions, IR_partial = self._dead_code_removal(IR, write_depend, instructions)
+        instructions, IR_partial = phase("dead_code_removal", self._dead_code_removal, IR, write_depend, instructions)
 
         #Regenerate New IR with update instruction list
-        IR, writes, depend, edges, write_depend = self._gen_dependencies(IR_partial)
+        IR, writes, depend, edges, write_depend = phase("dependencies", self._gen_dependencies, IR_partial)
         
-        #Constant Folding then Propgation Loop. 
+        #Constant Folding and Propgation.
         #Evaluates constant expressions and Replaces variables with constants.
-        constant_folding_bool = True
-        while(constant_folding_bool):
-            #Constant Folding
-            IR = self._constant_folding(IR)
-            
-            #Constant Propogation
-            IR_partial, constant_folding_bool = self._constant_propogation(IR, write_depend)
+        IR_partial = phase("constant_folding_propagation", self._constant_folding_propagation, IR, write_depend)
+
+        #Global Value Numbering.
+        #Removes recomputed values and rewires later uses to the first computation.
+        IR_partial = phase("value_numbering", self._value_numbering, IR_partial)
 
-            #Regenerate New IR with update instruction list
-            IR, writes, depend, edges, write_depend = self._gen_dependencies(IR_partial)
+        #Register Renaming.
+        #Gives every definition its own register, removing false (WAR and WAW) dependencies.
+        if rename:
+            IR_partial = phase("register_renaming", self._rename_registers, IR_partial)
 
+        #Tree-Height Reduction.
+        #Reassociates ADD and MUL chains into balanced trees, changing floating-point rounding.
+        if reassociate:
+            IR_partial = phase("reassociation", self._reassociate, IR_partial)
 
-        instructions = self._IR_to_instruction(IR)
+        #Strength Reduction.
+        #Replaces operations with cheaper ones, and fuses MUL and ADD into FMA, using the costs in 'operation_latency.json'.
+        if strength_reduction:
+            IR_partial = phase("strength_reduction", self._strength_reduction, IR_partial, fma, reassociate)
+
+        #Regenerate New IR with update instruction list
+        IR, writes, depend, edges, write_depend = phase("dependencies", self._gen_dependencies, IR_partial)
 
         #Generate DFG output and image
-        self._dfg(instructions,edges)
-        
+        if dfg:
+            instructions = phase("IR_to_instruction", self._IR_to_instruction, IR)
+            phase("dfg", self._dfg, instructions, edges, dfg == "render")
+
         return IR, depend, writes, write_depend
 
-class CodeGen():
+class WorkloadBalancer():
     """
-    A class that generates compiled code for a multi-PE environment.
+    A class that moves tasks between PEs in place while tracking the execution time of each PE incrementally.
+    Execution times are kept in a max heap and a min heap with lazily removed stale entries,
+    so each move costs O(log PEs) instead of copying and re-summing every assignment.
     """
-    def __init__(self,num_PEs,path="/") -> None:
+    def __init__(self, assignments, cycle_times) -> None:
         """
-        Initializes the CodeGen.
+        Initializes the WorkloadBalancer.
 
         Args:
-            num_PEs (int): The number of processing elements (PEs).
-            path (str, optional): The path to the input files. Defaults to "/".
+            assignments (list): The task assignments to PEs.
+            cycle_times (dict): Cycle time of each operation.
         """
-        self.file_path = path
-        self.num_PEs = num_PEs
-        with open(input_folder+'operation_latency.json', 'r') as f:
-            self.cycle_times = json.load(f)
-    
-    def generate_compiled_code(self,IR):
+        self.cycle_times = cycle_times
+        self.tasks = [deque(tasks) for tasks in assignments]
+        self.execution_times = [sum(self._cycle_time(task) for task in tasks) for tasks in self.tasks]
+        self.max_heap = [(-time, pe_id) for pe_id, time in enumerate(self.execution_times)]
+        self.min_heap = [(time, pe_id) for pe_id, time in enumerate(self.execution_times)]
+        heapq.heapify(self.max_heap)
+        heapq.heapify(self.min_heap)
+        self.last_move = None
+
+    def _cycle_time(self, task):
+        if task and task[0] in self.cycle_times:
+            return self.cycle_times[task[0]]
+        return 0
+
+    def _set_execution_time(self, pe_id, time):
+        self.execution_times[pe_id] = time
+        heapq.heappush(self.max_heap, (-time, pe_id))
+        heapq.heappush(self.min_heap, (time, pe_id))
+
+    def max_pe(self):
         """
-        Generates compiled code for a given set of intermediate representation (IR) tasks.
+        Gets the most loaded PE, the lowest PE id on ties.
 
-        Args:
-            IR (list): The list of intermediate representation (IR) tasks.
+        Returns:
+            int: The PE id.
         """
-        
-        # Step 1: Assign initial tasks to PEs
-        assignments = self._initial_assignment(IR)
-        
-        #Step 2: calculates execution times for each PE
-        execution_times = self._calculate_execution_times(assignments)
+        while -self.max_heap[0][0] != self.execution_times[self.max_heap[0][1]]:
+            heapq.heappop(self.max_heap)
+        return self.max_heap[0][1]
 
-        # Step 3: Check workload imbalance
-        max_execution_time = max(execution_times)
-        min_execution_time = min(execution_times)
-        cur_imbalance = max_execution_time - min_execution_time
-
-        iteration = 0
+    def min_pe(self):
+        """
+        Gets the least loaded PE, the lowest PE id on ties.
 
-        print(f"Iteration: {iteration}\t Initial Imbalance: {cur_imbalance}")
-        #Repeat 4-6
-        while True:
-            
-            iteration += 1 
-            # Step 4: Task migration or swapping strategy
-            new_assignments = self._rebalance_workload(assignments, execution_times)
+        Returns:
+            int: The PE id.
+        """
+        while self.min_heap[0][0] != self.execution_times[self.min_heap[0][1]]:
+            heapq.heappop(self.min_heap)
+        return self.min_heap[0][1]
 
-            # Step 5: Calculate execution cost for each PE
-            execution_times = self._calculate_execution_times(new_assignments)
+    def imbalance(self):
+        """
+        Gets the current workload imbalance.
 
-            # Step 6: Check workload imbalance
-            max_execution_time = max(execution_times)
-            min_execution_time = min(execution_times)
-            new_imbalance = max_execution_time - min_execution_time
+        Returns:
+            int: Difference between the highest and lowest execution time.
+        """
+        return self.execution_times[self.max_pe()] - self.execution_times[self.min_pe()]
 
-            print(f"Iteration: {iteration}\t New Imbalance: {new_imbalance}, Current Imbalance: {cur_imbalance}")
-            if new_imbalance >= cur_imbalance or cur_imbalance==0:
-                print(f"Stopping with an Current Imbalance of {cur_imbalance}")
-                
-                break  # Terminate if workload is balanced within threshold or maximum iterations reached
-            cur_imbalance = new_imbalance
-            assignments = new_assignments
-            
-        #Step 7
-        synced_tasks = self._sync(assignments, IR)
-        for pe_id, assigned_tasks in enumerate(synced_tasks):
-            # Step 8: Generate output code for each PE
-            code = self._generate_code(assigned_tasks)
+    def move(self):
+        """
+        Moves the first task of the most loaded PE to the end of the least loaded PE.
+        """
+        max_index, min_index = self.max_pe(), self.min_pe()
+        if not self.tasks[max_index]:
+            self.last_move = None
+            return
+        task = self.tasks[max_index].popleft()
+        self.tasks[min_index].append(task)
+        self._set_execution_time(max_index, self.execution_times[max_index] - self._cycle_time(task))
+        self._set_execution_time(min_index, self.execution_times[min_index] + self._cycle_time(task))
+        self.last_move = (max_index, min_index)
+
+    def undo(self):
+        """
+        Reverts the last move.
+        """
+        if self.last_move is None:
+            return
+        max_index, min_index = self.last_move
+        task = self.tasks[min_index].pop()
+        self.tasks[max_index].appendleft(task)
+        self._set_execution_time(min_index, self.execution_times[min_index] - self._cycle_time(task))
+        self._set_execution_time(max_index, self.execution_times[max_index] + self._cycle_time(task))
+        self.last_move = None
+
+    def assignments(self):
+        """
+        Gets the current task assignments.
 
-            # Step 9: Dump output code to files
-            self._dump_code_to_file(code, pe_id)
+        Returns:
+            list: The task assignments to PEs.
+        """
+        return [list(tasks) for tasks in self.tasks]
 
-    def _initial_assignment(self,tasks):
+class CompiledProgram():
+    """
+    A class that holds the compiled code of every PE, so CodeGen can hand it to the Simulator
+    without writing and re-reading 'PE_n_code.txt' files.
+    """
+    def __init__(self, synced_tasks, cycle_times, issue_cycles=None) -> None:
         """
-        Assigns initial tasks to PEs.
+        Initializes the CompiledProgram.
 
         Args:
-            tasks (list): The list of tasks.
+            synced_tasks (list): The synchronized tasks of each PE, with "NOP" for idle cycles.
+            cycle_times (dict): Cycle time of each operation.
+            issue_cycles (dict, optional): Cycles each operation holds its PE for. Defaults to cycle_times.
+        """
+        #Each PE's instructions as lists of tokens, without the dependencies only CodeGen needs
+        self.pe_code = [encode_nop_runs(["NOP"] if task == "NOP" else list(task[:len(task)-1]) for task in tasks) for tasks in synced_tasks]
+        self.num_PEs = len(synced_tasks)
+        issue_cycles = issue_cycles or cycle_times
+
+        #Last cycle any instruction is still running in
+        self.makespan = 0
+        for tasks in synced_tasks:
+            cycle = 1
+            for task in tasks:
+                if task == "NOP":
+                    self.makespan = max(self.makespan, cycle)
+                    cycle += 1
+                else:
+                    self.makespan = max(self.makespan, cycle + cycle_times[task[0]] - 1)
+                    cycle += issue_cycles[task[0]]
 
-        Returns:
-            list: The initial task assignments to PEs.
+    def code(self):
         """
-        
-        assignments = [[] for _ in range(self.num_PEs)]
-        task_index = 0
+        Gets the code of each PE in the format loaded by the Simulator.
 
-        for task in tasks:
-            pe_id = task_index % self.num_PEs
-            assignments[pe_id].append(task)
-            task_index += 1
+        Returns:
+            list: Instructions of each PE as lists of tokens, such as ['ADD', 't2', 't1', '4'],
+                with each run of n NOPs as ['NOP', 'n'].
+        """
+        return [list(pe_code) for pe_code in self.pe_code]
+
+def encode_nop_runs(pe_code):
+    """
+    Run-length encodes the NOPs of a PE's code, so idle cycles cost one entry per run instead of one per cycle.
+
+    Args:
+        pe_code (iterable): The PE's instructions as lists of tokens, with NOPs as ['NOP'] or runs as ['NOP', 'n'].
 
+    Returns:
+        list: The instructions with each run of n NOPs as a single ['NOP', 'n'].
+    """
+    encoded = []
+    nops = 0
+    for instruction in pe_code:
+        if instruction[0] == "NOP":
+            nops += int(instruction[1]) if len(instruction) > 1 else 1
+            continue
+        if nops:
+            encoded.append(["NOP", str(nops)])
+            nops = 0
+        encoded.append(instruction)
+    if nops:
+        encoded.append(["NOP", str(nops)])
+    return encoded
+
+#Binary compiled code format. A header, then for each PE its first record and record count,
+#then the interning table of names separated by NUL bytes, then the fixed-width records.
+#A record is (opcode, dst id, src1 id, src2 id, src3 id) with -1 for unused operands,
+#and a run of n NOPs is a single NOP record with n as its first operand.
+BINARY_MAGIC = b"PEBC"
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct("<4sHHII")  #magic, version, PE count, name count, names size
+BINARY_PE_ENTRY = struct.Struct("<II")     #first record, record count
+BINARY_RECORD = struct.Struct("<iiiii")    #opcode, dst, src1, src2, src3
+
+def load_code_file(file_name):
+    """
+    Reads one PE's compiled code from a 'PE_n_code.txt' file.
+
+    Args:
+        file_name (str): Name of the code file.
+
+    Returns:
+        list: Instructions as lists of tokens, such as ['ADD', 't2', 't1', '4'].
+    """
+    with open(file_name) as f:
+        data = f.read()
+    return [[j.replace(" ",'') for j in i.split(",")]for i in data.split("\n") if i]
+
+def write_compiled_binary(code, file_name):
+    """
+    Writes compiled multi-core code to the binary format, run-length encoding NOPs.
+
+    Args:
+        code (CompiledProgram or list): Compiled code from CodeGen, or instructions of each PE as lists of tokens,
+            where ['NOP', 'n'] is a run of n NOPs.
+        file_name (str): Name of the binary file.
+    """
+    if isinstance(code, CompiledProgram):
+        code = code.code()
+
+    names, name_ids = [], {}
+    def intern(name):
+        if name not in name_ids:
+            name_ids[name] = len(names)
+            names.append(name)
+        return name_ids[name]
+
+    pe_entries, records = [], []
+    for pe_code in code:
+        first = len(records)
+        for instruction in pe_code:
+            if instruction[0] == "NOP":
+                count = int(instruction[1]) if len(instruction) > 1 else 1
+                if records[first:] and records[-1][0] == OPCODE_IDS["NOP"]:
+                    records[-1][1] += count
+                else:
+                    records.append([OPCODE_IDS["NOP"], count, -1, -1, -1])
+                continue
+            operands = [intern(token) for token in instruction[1:]]
+            records.append([OPCODE_IDS[instruction[0]]] + operands + [-1] * (4 - len(operands)))
+        pe_entries.append((first, len(records) - first))
+
+    names_blob = "\0".join(names).encode("utf-8")
+    with open(file_name, "wb") as f:
+        f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(code), len(names), len(names_blob)))
+        for entry in pe_entries:
+            f.write(BINARY_PE_ENTRY.pack(*entry))
+        f.write(names_blob)
+        for record in records:
+            f.write(BINARY_RECORD.pack(*record))
+
+def read_compiled_binary(file_name):
+    """
+    Reads compiled multi-core code from the binary format through mmap, without parsing text.
+    Runs of NOPs stay run-length encoded, and the Simulator skips over them without expanding them.
+
+    Args:
+        file_name (str): Name of the binary file.
+
+    Returns:
+        list: Instructions of each PE as lists of tokens, with each run of n NOPs as ['NOP', 'n'],
+            which Simulator.run() accepts.
+    """
+    with open(file_name, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, version, pe_count, name_count, names_size = BINARY_HEADER.unpack_from(mm, 0)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            raise(ValueError(f"Error! '{file_name}' is not a version {BINARY_VERSION} compiled code file."))
+
+        offset = BINARY_HEADER.size
+        pe_entries = [BINARY_PE_ENTRY.unpack_from(mm, offset + pe * BINARY_PE_ENTRY.size) for pe in range(pe_count)]
+        offset += pe_count * BINARY_PE_ENTRY.size
+        names = mm[offset:offset + names_size].decode("utf-8").split("\0") if name_count else []
+        offset += names_size
+
+        code = []
+        for first, count in pe_entries:
+            pe_code = []
+            for pos in range(first, first + count):
+                opcode, *operands = BINARY_RECORD.unpack_from(mm, offset + pos * BINARY_RECORD.size)
+                if opcode == OPCODE_IDS["NOP"]:
+                    pe_code.append(["NOP", str(operands[0])])
+                else:
+                    pe_code.append([OPCODES[opcode]] + [names[operand] for operand in operands if operand != -1])
+            code.append(pe_code)
+    return code
+
+def convert_code_files_to_binary(path, pe_count, file_name):
+    """
+    Converts the 'PE_n_code.txt' files of a compiled program to the binary format.
+
+    Args:
+        path (str): The path to the code files.
+        pe_count (int): The number of processing elements (PEs).
+        file_name (str): Name of the binary file.
+    """
+    write_compiled_binary([load_code_file(f'{path}PE_{pe}_code.txt') for pe in range(pe_count)], file_name)
+
+class CompileCache():
+    """
+    An on-disk cache of parsed IR and compiled programs, so unchanged kernels skip straight to simulation.
+    Entries are addressed by a hash of the source code, the latency table, the core count, the scheduler and
+    the source of lib.py itself, and the least recently used entries are evicted once the cache grows past its size limit.
+    """
+
+    def __init__(self, path=cache_folder, max_bytes=64 * 1024 * 1024) -> None:
+        """
+        Initializes the CompileCache.
+
+        Args:
+            path (str): The folder holding the cache entries.
+            max_bytes (int): Total size of the entries kept before evicting the least recently used ones.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        with open(input_folder+'operation_latency.json', 'r') as f:
+            self.cycle_times = json.load(f)
+        #Hash of this module's source, so entries from an older parser or code generator are never reused
+        with open(__file__, 'rb') as f:
+            self.source_hash = hashlib.sha256(f.read()).hexdigest()
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, source, num_PEs=None, scheduler=None):
+        """
+        Computes the address of a cache entry. The IR only depends on the source code and the latency table,
+        so it is cached under num_PEs=None and shared by every core count and scheduler.
+
+        Args:
+            source (str): The source code.
+            num_PEs (int): The number of processing elements (PEs), or None for the parsed IR.
+            scheduler (str): The CodeGen scheduler, or None for the parsed IR.
+
+        Returns:
+            str: Hex digest addressing the entry.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([self.source_hash, source, self.cycle_times, num_PEs, scheduler], sort_keys=True).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Loads a cache entry and marks it as recently used.
+
+        Args:
+            key (str): Address from key().
+
+        Returns:
+            object: The cached value, or None on a miss.
+        """
+        file_name = os.path.join(self.path, key + ".pkl")
+        try:
+            with open(file_name, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+            return None
+        os.utime(file_name)
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a cache entry, then evicts the least recently used entries beyond the size limit.
+
+        Args:
+            key (str): Address from key().
+            value (object): Picklable value, such as the output of Parser.parse() or a CompiledProgram.
+        """
+        file_name = os.path.join(self.path, key + ".pkl")
+        temp_name = f"{file_name}.{os.getpid()}.tmp"
+        with open(temp_name, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_name, file_name)
+        self._evict()
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(".pkl"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, file_name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+class CodeGen():
+    """
+    A class that generates compiled code for a multi-PE environment.
+    """
+    def __init__(self,num_PEs,path="/",scheduler=None,registers=None) -> None:
+        """
+        Initializes the CodeGen.
+
+        Args:
+            num_PEs (int): The number of processing elements (PEs).
+            path (str, optional): The path to the input files. Defaults to "/".
+            scheduler (str, optional): "balance" for round-robin assignment with workload rebalancing,
+                or "critical_path" for critical-path list scheduling. Defaults to None, picking one with default_scheduler().
+            registers (int, optional): Size of each PE's register file. When set, the renamed registers are
+                mapped onto each PE's registers after scheduling, raising if the schedule needs more. Defaults to None.
+        """
+        if scheduler not in [None, "balance", "critical_path"]:
+            raise(ValueError(f"Unknown scheduler '{scheduler}'. Use 'balance' or 'critical_path'."))
+        self.file_path = path
+        self.num_PEs = num_PEs
+        self.registers = registers
+        self.register_pressure = []
+        self.makespan = 0
+        self.hooks = []
+        self.cycle_times, self.issue_cycles, self.units, self.forward_latency = load_latency_table(input_folder+'operation_latency.json')
+        self.scheduler = scheduler or default_scheduler(self.forward_latency)
+        #Average cycles of PE time an operation takes when its PE is kept busy,
+        #limited by how long it holds the PE and how often its units accept a new one
+        self.occupancy = {name: max(self.issue_cycles[name], math.ceil(interval / count)) for name, (count, interval) in self.units.items()}
+
+    def add_hook(self, hook):
+        """
+        Adds a hook told before and after every phase of code generation, such as a Profiler.
+
+        Args:
+            hook (object): Object with before(name, args) and after(name, result) methods.
+        """
+        self.hooks.append(hook)
+    
+    def generate_compiled_code(self,IR,write_files=True):
+        """
+        Generates compiled code for a given set of intermediate representation (IR) tasks.
+
+        Args:
+            IR (list): The list of intermediate representation (IR) tasks.
+            write_files (bool, optional): Also write each PE's code to 'PE_n_code.txt' in the path. Defaults to True.
+
+        Returns:
+            CompiledProgram: The compiled code for every PE, which the Simulator can run directly.
+        """
         
-        return assignments
+        if self.scheduler == "critical_path":
+            # Steps 1-6: Assign tasks to PEs by critical-path list scheduling
+            assignments = run_phase(self.hooks, "list_schedule", self._list_schedule, IR)
+        else:
+            # Steps 1-6: Assign tasks to PEs and rebalance the workload
+            assignments = run_phase(self.hooks, "balance_workload", self._balance_workload, IR)
+
+        #Step 7
+        synced_tasks = run_phase(self.hooks, "sync", self._sync, assignments, IR)
+        if self.registers is not None:
+            synced_tasks = run_phase(self.hooks, "register_allocation", self._allocate_registers, synced_tasks)
+        program = run_phase(self.hooks, "compiled_program", CompiledProgram, synced_tasks, self.cycle_times, self.issue_cycles)
+
+        # Step 8-9: Generate output code for each PE and dump it to files
+        if write_files:
+            run_phase(self.hooks, "export_compiled_code", self.export_compiled_code, program)
 
-    def _calculate_execution_times(self,assignments):
+        self.makespan = program.makespan
+        print(f"Makespan: {self.makespan} cycles")
+        return program
+
+    def export_compiled_code(self,program):
         """
-        Calculates the execution time for each PE.
+        Writes each PE's compiled code to 'PE_n_code.txt' in the path.
 
         Args:
-            assignments (list): The task assignments to PEs.
+            program (CompiledProgram): The compiled code for every PE.
+        """
+        for pe_id, pe_code in enumerate(program.pe_code):
+            # Step 8: Generate output code for each PE
+            code = self._generate_code(pe_code)
+
+            # Step 9: Dump output code to files
+            self._dump_code_to_file(code, pe_id)
+
+    def _balance_workload(self,IR):
+        """
+        Assigns tasks to PEs round-robin, then moves tasks from the most loaded PE to the least
+        loaded PE until the workload imbalance stops improving.
+
+        Args:
+            IR (list): The list of intermediate representation (IR) tasks.
 
         Returns:
-            list: The execution times for each PE.
+            list: The task assignments to PEs.
         """
-        execution_times = []
+        # Step 1: Assign initial tasks to PEs
+        balancer = WorkloadBalancer(run_phase(self.hooks, "initial_assignment", self._initial_assignment, IR), self.occupancy)
+
+        #Step 2-3: Check workload imbalance from the initial execution times of each PE
+        cur_imbalance = balancer.imbalance()
+
+        iteration = 0
+
+        print(f"Iteration: {iteration}\t Initial Imbalance: {cur_imbalance}")
+        #Repeat 4-6
+        while True:
+            
+            iteration += 1 
+            # Step 4-5: Move a task from the most loaded PE to the least loaded PE, updating their execution times
+            run_phase(self.hooks, "rebalance_iteration", balancer.move)
 
-        for assigned_tasks in assignments:
-            execution_time = 0
-            for task in assigned_tasks:
-                if task:
-                    task_name = task[0]
-                    if task_name in self.cycle_times:
-                        execution_time += self.cycle_times[task_name]
-            execution_times.append(execution_time)
+            # Step 6: Check workload imbalance
+            new_imbalance = balancer.imbalance()
 
-        return execution_times
+            print(f"Iteration: {iteration}\t New Imbalance: {new_imbalance}, Current Imbalance: {cur_imbalance}")
+            if new_imbalance >= cur_imbalance or cur_imbalance==0:
+                print(f"Stopping with an Current Imbalance of {cur_imbalance}")
+                balancer.undo()
+                break  # Terminate if workload is balanced within threshold or maximum iterations reached
+            cur_imbalance = new_imbalance
 
-    def _rebalance_workload(self,assignments, execution_times):
+        assignments = balancer.assignments()
+        return assignments
+
+    def _list_schedule(self,IR):
         """
-        Performs task migration or swapping to balance the workload.
+        Assigns tasks to PEs by critical-path list scheduling.
+        Ready tasks are taken from a heap in order of their longest latency-weighted path to a sink,
+        and each one is placed on the PE it can start on first, the earliest available PE on ties.
+        Results from other PEs arrive the forwarding latency after they finish, so a task follows the PE of
+        its producers when waiting for it beats forwarding their results to an idle PE.
+        A PE is available again once it has issued the task, which for pipelined operations is before the task's result is ready.
 
         Args:
-            assignments (list): The task assignments to PEs.
-            execution_times (list): The execution times for each PE.
+            IR (list): The list of intermediate representation (IR) tasks.
 
         Returns:
-            list: The new task assignments after workload rebalancing.
+            list: The task assignments to PEs, in start time order on each PE.
         """
+        instruction_cycle_times = [self.cycle_times[task[0]] for task in IR]
+        successors = [[] for _ in range(len(IR))]
+        indegree = [0] * len(IR)
+        for pos, task in enumerate(IR):
+            for dep in set(task[-1]):
+                successors[dep].append(pos)
+                indegree[pos] += 1
+
+        #Dependencies always point to earlier instructions, so a reverse sweep
+        #sees every successor before its predecessors.
+        priority = [0] * len(IR)
+        for pos in reversed(range(len(IR))):
+            priority[pos] = instruction_cycle_times[pos] + max((priority[succ] for succ in successors[pos]), default=0)
 
-        new_assignments = copy.deepcopy(assignments)
+        assignments = [[] for _ in range(self.num_PEs)]
+        finish_time = [0] * len(IR)
+        placement = [0] * len(IR)
+        pe_free = [0] * self.num_PEs
+        free_heap = [(0, pe_id) for pe_id in range(self.num_PEs)]    #(free time, PE), with stale entries skipped
+        ready = [(-priority[pos], pos) for pos in range(len(IR)) if indegree[pos] == 0]
+        heapq.heapify(ready)
+        makespan = 0
+
+        while ready:
+            _, pos = heapq.heappop(ready)
+            #Earliest start on each PE holding a dependency, with results from other PEs arriving the forwarding latency after they finish
+            dependencies = [(finish_time[dep], placement[dep]) for dep in set(IR[pos][-1])]
+            producers = {pe for _, pe in dependencies}
+            candidates = []
+            for pe_id in producers:
+                arrival = max(finish + (self.forward_latency if pe != pe_id else 0) for finish, pe in dependencies)
+                candidates.append((max(pe_free[pe_id], arrival), pe_free[pe_id], pe_id))
+
+            #Every other PE waits for all results to be forwarded, so only the one available first is a candidate
+            popped = []
+            while free_heap:
+                free_time, pe_id = heapq.heappop(free_heap)
+                if free_time != pe_free[pe_id]:
+                    continue
+                popped.append((free_time, pe_id))
+                if pe_id not in producers:
+                    arrival = max((finish + self.forward_latency for finish, _ in dependencies), default=0)
+                    candidates.append((max(free_time, arrival), free_time, pe_id))
+                    break
+            for entry in popped:
+                heapq.heappush(free_heap, entry)
+
+            start_time, _, pe_id = min(candidates)
+            finish_time[pos] = start_time + instruction_cycle_times[pos]
+            placement[pos] = pe_id
+            assignments[pe_id].append(IR[pos])
+            pe_free[pe_id] = start_time + self.occupancy[IR[pos][0]]
+            heapq.heappush(free_heap, (pe_free[pe_id], pe_id))
+            makespan = max(makespan, finish_time[pos])
+
+            for succ in successors[pos]:
+                indegree[succ] -= 1
+                if indegree[succ] == 0:
+                    heapq.heappush(ready, (-priority[succ], succ))
+
+        print(f"Critical Path: {max(priority, default=0)} cycles, Scheduled Makespan: {makespan} cycles")
+        return assignments
+
+    def _initial_assignment(self,tasks):
+        """
+        Assigns initial tasks to PEs.
+
+        Args:
+            tasks (list): The list of tasks.
+
+        Returns:
+            list: The initial task assignments to PEs.
+        """
         
-        max_index = execution_times.index(max(execution_times))
-        min_index = execution_times.index(min(execution_times))
+        assignments = [[] for _ in range(self.num_PEs)]
+        task_index = 0
 
-        # Swap a task from the most loaded PE to the least loaded PE
-        task_to_swap = new_assignments[max_index].pop(0)
-        new_assignments[min_index].append(task_to_swap)
+        for task in tasks:
+            pe_id = task_index % self.num_PEs
+            assignments[pe_id].append(task)
+            task_index += 1
 
-        return new_assignments
+        
+        return assignments
 
     def _sync(self,assignments, IR):
         """
         Synchronizes tasks across PEs.
+        Each task keeps a count of unfinished dependencies, each PE a ready heap of its tasks in list order,
+        and running tasks sit in a completion time heap. A PE issues the first ready task with a free functional unit
+        once it is no longer held by the task before it, so pipelined tasks overlap on the same PE.
+        A task waits the forwarding latency longer on dependencies from other PEs, while their results reach its PE.
+        Time jumps straight to the next completion, or the next cycle a PE or unit frees up or a result arrives,
+        and a PE with nothing to issue is padded with one NOP per idle cycle.
 
         Args:
             assignments (list): The task assignments to PEs.
@@ -616,65 +1793,196 @@ class CodeGen():
             list: The synchronized tasks across PEs.
         """
         sync_code = [[] for _ in range(len(assignments))]
-        hash = {}
         instruction_cycle_times = [self.cycle_times[task[0]] for task in IR]
-        for pos, instruc in enumerate(IR):
-            hash[instruc] = pos
-            
-
-        live_time = [0 for _ in range(len(assignments)) ]
-        current_instruction = ["NOP"for _ in range(len(assignments)) ]
-        numerical_assignment = [[(hash[task],task[-1]) for task in tasks] for tasks in assignments ]
 
-        instructions_done = set()
-        instructions_done.add(None)
+        #Identical instructions are interchangeable, so each copy is matched to the next unused position.
+        hash = {}
+        for pos, instruc in enumerate(IR):
+            hash.setdefault(instruc, []).append(pos)
+        hash = {instruc: iter(positions) for instruc, positions in hash.items()}
+        numerical_assignment = [[next(hash[task]) for task in tasks] for tasks in assignments]
+
+        indegree = [0] * len(IR)
+        successors = [[] for _ in range(len(IR))]
+        for pos, task in enumerate(IR):
+            for dep in set(task[-1]):
+                successors[dep].append(pos)
+                indegree[pos] += 1
+
+        #Ready tasks of each PE, keyed by their position in the PE's task list
+        task_owner = {}
+        ready = [[] for _ in range(len(assignments))]
+        for assignment_id, tasks in enumerate(numerical_assignment):
+            for order, pos in enumerate(tasks):
+                task_owner[pos] = (assignment_id, order)
+                if indegree[pos] == 0:
+                    ready[assignment_id].append((order, pos))
+
+        running = []    #(completion cycle, PE, task)
+        pe_free = [1] * len(assignments)    #Cycle each PE can issue its next task in
+        unit_free = [{name: [1] * count for name, (count, _) in self.units.items()} for _ in assignments]
+        wakeups = []    #Cycles a PE or unit frees up or a result arrives in
+        arrival = [0] * len(IR)     #Cycle the results of each task's dependencies are all on its PE
+        forwarding = []     #(arrival cycle, task) of tasks waiting for results from other PEs
+        instructions_done = 0
         cycle = 1
-        while len(IR) != len(instructions_done)-1:
-
-            for idx, (current, count) in enumerate(zip(current_instruction,live_time)):
-                if current != "NOP":
-                    if count <= 1:
-                        instructions_done.add(current)
-                        current_instruction[idx] = "NOP"
-                    live_time[idx] -= 1
-
-            for assignment_id, tasks in enumerate(numerical_assignment):
-                
-                if current_instruction[assignment_id] == "NOP":
-                    for task in tasks:
-                        #print(assignment_id, task, type(task[1]), task[0] not in instructions_done and task[1] in instructions_done)
-                        if task[0] not in instructions_done and all(num in instructions_done for num in task[1]):
-                            #print("Added ",task[0])
-                            current_instruction[assignment_id] = task[0]  
-                            live_time[assignment_id] = instruction_cycle_times[task[0]]
-                            sync_code[assignment_id].append(IR[task[0]])
-                            break
-
-                if current_instruction[assignment_id] == "NOP" and len(IR) != len(instructions_done)-1:
-                    sync_code[assignment_id].append("NOP")
+        while instructions_done != len(IR):
+
+            #Tasks finishing this cycle release their successors, which wait longer for results forwarded from another PE
+            while running and running[0][0] == cycle:
+                _, producer, pos = heapq.heappop(running)
+                instructions_done += 1
+                for succ in successors[pos]:
+                    assignment_id, order = task_owner[succ]
+                    arrival[succ] = max(arrival[succ], cycle + (self.forward_latency if assignment_id != producer else 0))
+                    indegree[succ] -= 1
+                    if indegree[succ] == 0:
+                        if arrival[succ] <= cycle:
+                            heapq.heappush(ready[assignment_id], (order, succ))
+                        else:
+                            heapq.heappush(forwarding, (arrival[succ], succ))
+                            heapq.heappush(wakeups, arrival[succ])
+            while forwarding and forwarding[0][0] <= cycle:
+                _, succ = heapq.heappop(forwarding)
+                assignment_id, order = task_owner[succ]
+                heapq.heappush(ready[assignment_id], (order, succ))
+
+            for assignment_id in range(len(assignments)):
+                if pe_free[assignment_id] > cycle:
+                    continue
+                #First ready task in list order with a free unit, the rest wait in the heap
+                waiting = []
+                while ready[assignment_id]:
+                    order, pos = heapq.heappop(ready[assignment_id])
+                    units = unit_free[assignment_id][IR[pos][0]]
+                    unit = units.index(min(units))
+                    if units[unit] <= cycle:
+                        break
+                    waiting.append((order, pos))
+                else:
+                    pos = None
+                for task in waiting:
+                    heapq.heappush(ready[assignment_id], task)
+                if pos is None:
+                    continue
+
+                name = IR[pos][0]
+                sync_code[assignment_id].append(IR[pos])
+                completion = cycle + instruction_cycle_times[pos]
+                pe_free[assignment_id] = cycle + self.issue_cycles[name]
+                units[unit] = cycle + self.units[name][1]
+                heapq.heappush(running, (completion, assignment_id, pos))
+                #Frees at the completion are already timed by the running heap
+                for free in (pe_free[assignment_id], units[unit]):
+                    if free != completion:
+                        heapq.heappush(wakeups, free)
+
+            if instructions_done == len(IR):
+                break
+            while wakeups and wakeups[0] <= cycle:
+                heapq.heappop(wakeups)
+            if not running and not wakeups:
+                raise(ValueError("Unable to synchronize tasks, remaining tasks have unmet dependencies."))
+
+            #Nothing changes until the next task finishes or a PE or unit frees up, so idle PEs wait with NOPs until then
+            next_cycle = min(([running[0][0]] if running else []) + wakeups[:1])
+            for assignment_id in range(len(assignments)):
+                if pe_free[assignment_id] <= cycle:
+                    sync_code[assignment_id].extend(["NOP"] * (next_cycle - cycle))
+            cycle = next_cycle
 
-            cycle += 1
         return  sync_code 
+
+    def _allocate_registers(self, synced_tasks):
+        """
+        Maps renamed registers onto each PE's register file, named 't{PE}_r{n}', and checks the register budget.
+        The synchronized code fixes the issue cycle of every instruction, so each value is live from
+        the issue of its definition until the later of its completion and the issue of its last reader on any PE.
+        Definitions are visited in issue order on each PE, and take the lowest numbered register of the
+        defining PE whose previous value is no longer live, so a PE uses as many registers as its peak pressure.
+        The schedule is left as it is: nothing is spilled, and a PE whose peak pressure is over the budget raises.
+
+        Args:
+            synced_tasks (list): The synchronized tasks of each PE, with every register written once.
+
+        Returns:
+            list: The synchronized tasks with physical registers.
+
+        Raises:
+            ValueError: If a register is written more than once, or a PE needs more registers than the budget.
+        """
+        definitions = {}    #Register -> (PE, issue cycle, completion cycle)
+        last_read = {}      #Register -> issue cycle of its last reader
+        for pe_id, tasks in enumerate(synced_tasks):
+            cycle = 1
+            for task in tasks:
+                if task == "NOP":
+                    cycle += 1
+                    continue
+                latency = self.cycle_times[task[0]]
+                if task[0] == "STORE":
+                    sources = [task[2]]
+                else:
+                    if task[1] in definitions:
+                        raise(ValueError(f"Register '{task[1]}' is written more than once. Register allocation needs renamed registers."))
+                    definitions[task[1]] = (pe_id, cycle, cycle + latency - 1)
+                    sources = [] if task[0] == "LOAD" else task[2:-1]
+                for token in sources:
+                    last_read[token] = max(last_read.get(token, 0), cycle)
+                cycle += self.issue_cycles[task[0]]
+
+        mapping = {}
+        self.register_pressure = [0] * len(synced_tasks)
+        by_pe = [[] for _ in synced_tasks]
+        for register, (pe_id, issue, completion) in definitions.items():
+            by_pe[pe_id].append((issue, max(completion, last_read.get(register, 0)), register))
+        for pe_id, values in enumerate(by_pe):
+            live = []   #(last live cycle, physical register)
+            free = []
+            for issue, end, register in sorted(values):
+                while live and live[0][0] < issue:
+                    heapq.heappush(free, heapq.heappop(live)[1])
+                physical = heapq.heappop(free) if free else len(live)
+                if physical >= self.registers:
+                    raise(ValueError(f"PE {pe_id} needs more than {self.registers} registers at cycle {issue}."))
+                heapq.heappush(live, (end, physical))
+                mapping[register] = f"t{pe_id}_r{physical}"
+                self.register_pressure[pe_id] = max(self.register_pressure[pe_id], len(live))
+
+        allocated = []
+        for tasks in synced_tasks:
+            pe_tasks = []
+            for task in tasks:
+                if task == "NOP":
+                    pe_tasks.append(task)
+                elif task[0] == "STORE":
+                    pe_tasks.append((task[0], task[1], mapping.get(task[2], task[2]), task[-1]))
+                elif task[0] == "LOAD":
+                    pe_tasks.append((task[0], mapping[task[1]], task[2], task[-1]))
+                else:
+                    pe_tasks.append((task[0], *[mapping.get(token, token) for token in task[1:-1]], task[-1]))
+            allocated.append(pe_tasks)
+        print(f"Registers Used: {self.register_pressure}")
+        return allocated
             
-    def _generate_code(self,tasks):
+    def _generate_code(self,pe_code):
         """
-        Generates output code for a given set of tasks.
+        Generates output code for a PE's compiled instructions.
 
         Args:
-            tasks (list): The list of tasks.
+            pe_code (list): The PE's instructions as lists of tokens.
 
         Returns:
             str: The generated output code.
         """
-        code = ""
-        self.cycle_times['N'] = 1
-        for task in tasks:
-            if task:
-                for idx in range(self.cycle_times[task[0]]):
-                        task_formated = str(task[:len(task)-1]).strip("()").replace("'", "") if task != "NOP" else task
-                        code += (task_formated + "\n")  if idx == 0 else "\n"
+        lines = []
+        for instruction in pe_code:
+            if instruction[0] == "NOP":
+                lines.append("NOP\n" * (int(instruction[1]) if len(instruction) > 1 else 1))
+            else:
+                lines.append(", ".join(instruction) + "\n" + "\n" * (self.issue_cycles[instruction[0]] - 1))
 
-        return code
+        return "".join(lines)
 
     def _dump_code_to_file(self,code, pe_id):
         """
@@ -686,12 +1994,100 @@ class CodeGen():
         """
         filename = f"{self.file_path}PE_{pe_id}_code.txt"
 
+        os.makedirs(self.file_path, exist_ok=True)
         with open(filename, "w") as file:
             file.write(code)
 
+class TraceWriter():
+    """
+    Streams the instructions issued during a simulation to a file from a background thread.
+    The simulation only appends (cycle, PE, position, instruction) events to a batch, and full batches
+    are handed to the writer thread, so formatting and file I/O stay out of the simulation loop.
+    Files ending in '.csv' get a 'cycle,pe,position,instruction' line per event. Any other file gets
+    fixed-width binary records of (cycle, PE, opcode, position), where position indexes the PE's code
+    with each run of NOPs as one entry.
+    """
+    RECORD = struct.Struct("<IHBI")     #cycle, PE, opcode, position
+
+    def __init__(self, file_name, batch_size=4096) -> None:
+        """
+        Initializes the TraceWriter and starts its writer thread.
+
+        Args:
+            file_name (str): Name of the trace file.
+            batch_size (int, optional): Number of events handed to the writer thread at a time. Defaults to 4096.
+        """
+        self.csv = file_name.endswith(".csv")
+        self.batch_size = batch_size
+        self._batch = []
+        self._queue = queue.Queue(maxsize=64)
+        self._error = None
+        self._file = open(file_name, "w" if self.csv else "wb")
+        if self.csv:
+            self._file.write("cycle,pe,position,instruction\n")
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    def write(self, cycle, pe, pos, instruction):
+        """
+        Adds an issued instruction to the trace.
+
+        Args:
+            cycle (int): The cycle the instruction issued.
+            pe (int): The PE that issued it.
+            pos (int): Its position in the PE's code.
+            instruction (list): The instruction tokens.
+
+        Raises:
+            Exception: The error the writer thread failed with, if any.
+        """
+        if self._error is not None:
+            raise(self._error)
+        self._batch.append((cycle, pe, pos, instruction))
+        if len(self._batch) >= self.batch_size:
+            self._queue.put(self._batch)
+            self._batch = []
+
+    def close(self):
+        """
+        Hands the remaining events to the writer thread, waits for it to finish and closes the file.
+
+        Raises:
+            Exception: The error the writer thread failed with, if any.
+        """
+        if self._batch and self._error is None:
+            self._queue.put(self._batch)
+        self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            raise(self._error)
+
+    def _drain(self):
+        """
+        Writes batches of events until close() is called. A failed write is kept in _error for write() and
+        close() to raise, and later batches are still taken off the queue so they never block on it.
+        """
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                if self.csv:
+                    self._file.write("".join(f"{cycle},{pe},{pos},{' '.join(instruction)}\n" for cycle, pe, pos, instruction in batch))
+                else:
+                    self._file.write(b"".join(self.RECORD.pack(cycle, pe, OPCODE_IDS[instruction[0]], pos) for cycle, pe, pos, instruction in batch))
+            except Exception as error:
+                self._error = error
+
 class Simulator():
     """
     A class that simulates the execution of instructions in a multi-PE environment.
+    Each PE has its own register file in RG, and a result read on other PEs reaches their register files
+    the forwarding latency after it is ready.
     """
 
     def __init__(self, pes, file_path) -> None:
@@ -703,12 +2099,20 @@ class Simulator():
             file_path (str): The path to the input files.
         """
         self.MEM = {}
-        self.RG = {}
+        self.RG = [{} for _ in range(pes)]
+        self.counters = {}
+        self.trace = None
         self.pe_count = pes
         self.file_path = file_path
-        with open(input_folder+'operation_latency.json', 'r') as f:
-            self.cycle_times = json.load(f)
+        self.cycle_times, self.issue_cycles, self.units, self.forward_latency = load_latency_table(input_folder+'operation_latency.json')
         self.cycle_times['NOP'] = 1
+        self.issue_cycles['NOP'] = 1
+        self.operations = {
+                'ADD': operator.add,
+                'SUB': operator.sub,
+                'MUL': operator.mul,
+                'DIV': operator.truediv,
+            }
     
     def _load_files(self):
         """
@@ -717,28 +2121,265 @@ class Simulator():
         Returns:
             list: The loaded code for each processing element.
         """
-        code = []
-        for pe in range(self.pe_count):
-            file_name = f'PE_{pe}_code.txt'
-            with open(self.file_path+file_name) as f:
-                data = f.read()
-            code.append([[j.replace(" ",'') for j in i.split(",")]for i in data.split("\n") if i])
-        return code
+        return [load_code_file(f'{self.file_path}PE_{pe}_code.txt') for pe in range(self.pe_count)]
+
+    def _prepare_code(self, code):
+        """
+        Gets the code to simulate as lists of instruction tokens, with each run of NOPs as a single
+        ['NOP', 'n'] entry, so every pass over the code is linear in its instructions rather than its cycles.
+
+        Args:
+            code (CompiledProgram or list): Code for each processing element as lists of instruction tokens.
+                None loads the code from the input files.
 
-    def run(self):
+        Returns:
+            list: The code for each processing element.
+        """
+        if code is None:
+            code = self._load_files()
+        elif isinstance(code, CompiledProgram):
+            if code.num_PEs != self.pe_count:
+                raise(ValueError(f"Compiled code is for {code.num_PEs} PEs, but the Simulator has {self.pe_count} PEs."))
+            return code.code()
+        return [encode_nop_runs(pe_code) for pe_code in code]
+
+    def run(self, code=None, fast=False, trace=TRACE_CYCLE, trace_buffer=None, trace_file=None):
         """
         Runs the simulation.
 
+        Args:
+            code (CompiledProgram or list, optional): Compiled code from CodeGen, or code for each processing
+                element as lists of instruction tokens. Defaults to loading the code from the input files.
+            fast (bool, optional): Skip idle and stalled cycles by jumping straight to the next
+                instruction boundary, without printing each cycle. Defaults to False.
+            trace (int, optional): What to print: TRACE_OFF, TRACE_SUMMARY, TRACE_INSTRUCTION or TRACE_CYCLE.
+                Defaults to TRACE_CYCLE, which prints nothing when fast is set.
+            trace_buffer (int, optional): Keep the instructions issued in the last trace_buffer cycles in self.trace,
+                as (cycle, PE, position, instruction) events. Defaults to None, keeping nothing.
+            trace_file (str, optional): Stream every issued instruction to this file in a background thread,
+                see TraceWriter. Defaults to None.
+
+        Returns:
+            int: The total number of cycles executed. Performance counters of the run are left in self.counters,
+                see _collect_counters().
+        """
+        code = self._prepare_code(code)
+        #Decode every instruction once, so each cycle only dispatches
+        decoded = [[self._decode(instruction, pe) for instruction in pe_code] for pe, pe_code in enumerate(code)]
+        schedule = [self._issue_schedule(pe_code) for pe_code in code]
+        forwards = self._forwards(code)
+        writer = TraceWriter(trace_file) if trace_file else None
+        #A PE issues at most one instruction per cycle, so the last trace_buffer cycles fit in trace_buffer*PEs events
+        self.trace = deque(maxlen=trace_buffer * self.pe_count) if trace_buffer else None
+        on_issue = self._issue_tracer(trace, writer)
+        try:
+            if fast:
+                cycles = self._run_event_driven(code, decoded, schedule, forwards, on_issue)
+            else:
+                cycles = self._run_cycles(code, decoded, schedule, forwards, on_issue, trace == TRACE_CYCLE)
+        finally:
+            if writer:
+                writer.close()
+
+        self.counters = self._collect_counters(code, schedule, cycles)
+        if self.trace is not None:
+            self.trace = [event for event in self.trace if event[0] > cycles - trace_buffer]
+        if trace == TRACE_SUMMARY:
+            retired = sum(pe_counters["retired"] for pe_counters in self.counters["pes"])
+            print(f"Simulated {cycles} cycles on {self.pe_count} PEs, {retired} instructions retired, {self.counters['ideal_cycles']} ideal cycles")
+        return cycles
+
+    def _issue_tracer(self, trace, writer):
+        """
+        Builds the callback run for every issued instruction, or None when nothing traces instructions,
+        so an untraced simulation pays nothing per instruction.
+
+        Args:
+            trace (int): The trace level.
+            writer (TraceWriter): Streams issued instructions to a file, or None.
+
+        Returns:
+            function: Called with the cycle, PE, position and tokens of each issued instruction, or None.
+        """
+        buffer = self.trace
+        if trace != TRACE_INSTRUCTION and buffer is None and writer is None:
+            return None
+
+        def on_issue(cycle, pe, pos, instruction):
+            if instruction[0] == "NOP":
+                return
+            if trace == TRACE_INSTRUCTION:
+                print(f"Cycle:{cycle}, PE_{pe}: {', '.join(instruction)}")
+            if buffer is not None:
+                buffer.append((cycle, pe, pos, instruction))
+            if writer:
+                writer.write(cycle, pe, pos, instruction)
+        return on_issue
+
+    def _issue_schedule(self, pe_code):
+        """
+        Computes the issue cycle of each instruction of a PE. A PE issues its instructions in order, each one once
+        the instruction before it no longer holds the PE, waiting while every functional unit of its operation is busy.
+        Pipelined operations only hold the PE for their issue cycle, so independent ones overlap.
+
+        Args:
+            pe_code (list): The PE's instructions as lists of tokens.
+
+        Returns:
+            list: The issue cycle of each instruction, where a run of NOPs issues at the cycle of its first NOP.
+        """
+        unit_free = {}
+        schedule = []
+        cycle = 1
+        for instruction in pe_code:
+            name = instruction[0]
+            if name in self.units:
+                count, interval = self.units[name]
+                units = unit_free.setdefault(name, [1] * count)
+                unit = units.index(min(units))
+                cycle = max(cycle, units[unit])
+                units[unit] = cycle + interval
+            schedule.append(cycle)
+            cycle += self._issue_length(instruction)
+        return schedule
+
+    def _issue_length(self, instruction):
+        """
+        Computes the number of cycles an instruction holds its PE. ['NOP', 'n'] is a run of n NOPs,
+        as read from the binary format.
+
+        Args:
+            instruction (list): The instruction tokens.
+
+        Returns:
+            int: The cycles until the PE issues its next instruction.
+        """
+        if instruction[0] == "NOP" and len(instruction) > 1:
+            return int(instruction[1]) * self.issue_cycles["NOP"]
+        return self.issue_cycles[instruction[0]]
+
+    def _last_cycle(self, code, schedule):
+        """
+        Finds the cycle the simulation stops at, which is when the first PE issues its last instruction.
+        The last NOP of a run issues at the end of the run.
+
+        Args:
+            code (list): Code for each processing element as lists of instruction tokens.
+            schedule (list): Issue cycle of each instruction of each processing element.
+
+        Returns:
+            int: The last cycle simulated, or 0 when a PE has no code.
+        """
+        if not all(code[pe] for pe in range(self.pe_count)):
+            return 0
+        return min(schedule[pe][-1] + self._issue_length(code[pe][-1]) - self.issue_cycles[code[pe][-1][0]]
+                   for pe in range(self.pe_count))
+
+    def _forwards(self, code):
+        """
+        Finds the PEs each instruction's result is forwarded to, which are the other PEs reading its register.
+
+        Args:
+            code (list): Code for each processing element as lists of instruction tokens.
+
+        Returns:
+            list: For each instruction of each PE, (cycles until its result reaches other PEs, register, PEs)
+                or None when no other PE reads it.
+        """
+        readers = {}    #Register -> PEs reading it
+        for pe, pe_code in enumerate(code):
+            for instruction in pe_code:
+                sources = instruction[2:3] if instruction[0] == "STORE" else [] if instruction[0] in ["LOAD", "NOP"] else instruction[2:]
+                for token in sources:
+                    if token[0] == 't':
+                        readers.setdefault(token, set()).add(pe)
+
+        forwards = []
+        for pe, pe_code in enumerate(code):
+            pe_forwards = []
+            for instruction in pe_code:
+                destinations = [] if instruction[0] in ["STORE", "NOP"] else sorted(readers.get(instruction[1], set()) - {pe})
+                delay = self.cycle_times[instruction[0]] + self.forward_latency
+                pe_forwards.append((delay, instruction[1], destinations) if destinations else None)
+            forwards.append(pe_forwards)
+        return forwards
+
+    def _send(self, deliveries, cycle, pe, pos, forward):
+        """
+        Queues the result of an instruction for delivery to the register files of the other PEs reading it.
+        The value is copied when it is computed, so later writes to the register on its PE are not forwarded.
+
+        Args:
+            deliveries (list): Heap of pending deliveries.
+            cycle (int): The instruction's issue cycle.
+            pe (int): The instruction's PE.
+            pos (int): The instruction's position on its PE.
+            forward (tuple): (cycles until its result reaches other PEs, register, PEs) from _forwards().
+        """
+        delay, register, destinations = forward
+        heapq.heappush(deliveries, (cycle + delay, pe, pos, register, self._read_register(pe, register), destinations))
+
+    def _deliver(self, deliveries, cycle):
+        """
+        Writes the forwarded results arriving by the given cycle into the register files of their PEs.
+
+        Args:
+            deliveries (list): Heap of pending deliveries.
+            cycle (int): The current cycle.
+        """
+        while deliveries and deliveries[0][0] <= cycle:
+            _, _, _, register, value, destinations = heapq.heappop(deliveries)
+            for destination in destinations:
+                self._write_register(destination, register, value)
+
+    def _read_register(self, pe, register):
+        """
+        Reads a register from a PE's register file.
+
+        Args:
+            pe (int): The PE.
+            register (str): The register.
+
+        Returns:
+            float: The register's value.
+        """
+        return self.RG[pe][register]
+
+    def _write_register(self, pe, register, value):
+        """
+        Writes a register in a PE's register file.
+
+        Args:
+            pe (int): The PE.
+            register (str): The register.
+            value (float): The value to write.
+        """
+        self.RG[pe][register] = value
+
+    def _run_cycles(self, code, decoded, schedule, forwards, on_issue, print_cycles):
+        """
+        Runs the simulation one cycle at a time.
+
+        Args:
+            code (list): Code for each processing element as lists of instruction tokens.
+            decoded (list): Decoded instructions for each processing element.
+            schedule (list): Issue cycle of each instruction of each processing element.
+            forwards (list): Forwarded result of each instruction of each processing element, see _forwards().
+            on_issue (function): Called for every issued instruction, or None.
+            print_cycles (bool): Print the instruction running on every PE each cycle.
+
         Returns:
             int: The total number of cycles executed.
         """
-        code = self._load_files()
         instruction_running = ["NOP"]*self.pe_count
         live_cycles = [0]*self.pe_count
         instruction_pos = [0]*self.pe_count
+        deliveries = []
+        last_cycle = self._last_cycle(code, schedule)
         cycle = 1
-        while all((instruction_pos[pe] < len(code[pe])) for pe in range(self.pe_count)):
+        while cycle <= last_cycle:
             
+            self._deliver(deliveries, cycle)
             for pe in range(self.pe_count):
 
                 pos = instruction_pos[pe]
@@ -748,62 +2389,513 @@ class Simulator():
                 #Cycle over. Update with New instruction
                 if live_cycles[pe] == 0:
                     instruction_running[pe] = code[pe][pos]
-                    live_cycles[pe] = self.cycle_times[instruction_running[pe][0]]
+                    next_issue = schedule[pe][pos + 1] if pos + 1 < len(code[pe]) else cycle + self._issue_length(code[pe][pos])
+                    live_cycles[pe] = next_issue - cycle
                     instruction_pos[pe] += 1
-                    self._execute(instruction_running[pe])
+                    decoded[pe][pos]()
+                    if forwards[pe][pos]:
+                        self._send(deliveries, cycle, pe, pos, forwards[pe][pos])
+                    if on_issue:
+                        on_issue(cycle, pe, pos, instruction_running[pe])
             
-            
-            message = f'Cycle:{cycle},'
-            message = f'{message:<12}'
-            for idx,pe in enumerate(range(self.pe_count)):
-                instruction_pe = f"PE_{pe}: {', '.join(instruction_running[pe])}[{live_cycles[pe]}], "
-                column_pos = 30 
-                message += f"{instruction_pe:<{column_pos}}"
-            print(message)
+            if print_cycles:
+                message = f'Cycle:{cycle},'
+                message = f'{message:<12}'
+                for idx,pe in enumerate(range(self.pe_count)):
+                    #Each cycle of a NOP run is printed as a single NOP
+                    if instruction_running[pe][0] == "NOP":
+                        instruction_pe = f"PE_{pe}: NOP[1], "
+                    else:
+                        instruction_pe = f"PE_{pe}: {', '.join(instruction_running[pe])}[{live_cycles[pe]}], "
+                    column_pos = 30 
+                    message += f"{instruction_pe:<{column_pos}}"
+                print(message)
 
             #Update cycle times
             for pe in range(self.pe_count):
                 live_cycles[pe] -= 1
             cycle += 1
         return cycle-1 if cycle-1 > 0 else 0
+
+    def _collect_counters(self, code, schedule, cycles):
+        """
+        Collects performance counters of a run. The issue schedule fixes when every instruction holds its PE, so the
+        counters follow from the code and the number of cycles executed. A PE stalls from the end of one instruction
+        until the issue of its next one, and is idle after its last instruction. Each stall is put down to what the
+        waiting instruction waited on longest: an operand produced on another PE, which also waits for the forward,
+        the latency of a result produced on the same PE, or a free functional unit of its operation. Operands cover
+        register and memory dependencies, including overwriting a value that is still being read.
+
+        Args:
+            code (list): Code for each processing element as lists of instruction tokens.
+            schedule (list): Issue cycle of each instruction of each processing element.
+            cycles (int): The total number of cycles executed.
+
+        Returns:
+            dict: The cycles executed, the ideal cycles of the critical path through the code's register and
+                memory dependencies, and for each PE its busy (issuing) cycles by opcode, the cycles results of
+                each opcode are in flight, its stall cycles split into remote operand, local latency and unit
+                stalls, its idle cycles and the instructions retired.
+        """
+        #Cycle every instruction waits for on other PEs and on its own PE, in issue order so producers come first
+        writer = {}     #Operand -> (PE, cycle its value is ready)
+        readers = {}    #Operand -> {PE: cycle its last read on that PE finishes}
+        waits = {}      #(PE, position) -> (remote operands ready, local operands ready)
+        ready = {}
+        ideal_cycles = 0
+        events = sorted((schedule[pe][pos], pe, pos) for pe, pe_code in enumerate(code)
+                        for pos, instruction in enumerate(pe_code) if instruction[0] != "NOP")
+        for issue, pe, pos in events:
+            instruction = code[pe][pos]
+            name = instruction[0]
+            if name == "STORE":
+                destination, sources = ("MEM", instruction[1]), [instruction[2]]
+            elif name == "LOAD":
+                destination, sources = instruction[1], [("MEM", instruction[2])]
+            else:
+                destination, sources = instruction[1], instruction[2:]
+            dependencies = [writer[operand] for operand in [*sources, destination] if operand in writer]
+            dependencies += readers.get(destination, {}).items()
+            remote = max((cycle + self.forward_latency for producer, cycle in dependencies if producer != pe), default=0)
+            local = max((cycle for producer, cycle in dependencies if producer == pe), default=0)
+            waits[pe, pos] = (remote, local)
+            for source in sources:
+                on_pe = readers.setdefault(source, {})
+                on_pe[pe] = max(on_pe.get(pe, 0), issue + self.cycle_times[name])
+            writer[destination] = (pe, issue + self.cycle_times[name])
+
+            #Earliest finish when only the data dependencies delay the instruction
+            finish = max((ready.get(source, 0) for source in sources), default=0) + self.cycle_times[name]
+            ready[destination] = finish
+            ideal_cycles = max(ideal_cycles, finish)
+
+        pes = []
+        for pe, pe_code in enumerate(code):
+            counters = {"busy_cycles": {}, "in_flight_cycles": {}, "stall_cycles": 0, "remote_stall_cycles": 0,
+                        "latency_stall_cycles": 0, "unit_stall_cycles": 0, "idle_cycles": 0, "retired": 0}
+            unit_free = {}
+            end = 1
+            for pos, instruction in enumerate(pe_code):
+                name = instruction[0]
+                if name == "NOP":
+                    continue
+                issue = schedule[pe][pos]
+                unit = 0
+                if name in self.units:
+                    count, interval = self.units[name]
+                    units = unit_free.setdefault(name, [1] * count)
+                    free = units.index(min(units))
+                    unit = units[free]
+                    units[free] = issue + interval
+
+                #Put the stall down to the latest of the cycles the instruction waited for
+                stall = max(min(issue, cycles + 1) - end, 0)
+                remote, local = waits[pe, pos]
+                if stall:
+                    kind = max((remote, "remote_stall_cycles"), (local, "latency_stall_cycles"), (unit, "unit_stall_cycles"),
+                               key=lambda wait: wait[0])[1]
+                    counters[kind] += stall
+                    counters["stall_cycles"] += stall
+                end = issue + self._issue_length(instruction)
+                if issue <= cycles:
+                    counters["busy_cycles"][name] = counters["busy_cycles"].get(name, 0) + min(end, cycles + 1) - issue
+                    in_flight = min(issue + self.cycle_times[name], cycles + 1) - issue
+                    counters["in_flight_cycles"][name] = counters["in_flight_cycles"].get(name, 0) + in_flight
+                    counters["retired"] += 1
+            counters["idle_cycles"] += max(cycles - end + 1, 0)
+            pes.append(counters)
+
+        return {"cycles": cycles, "ideal_cycles": ideal_cycles, "pes": pes}
     
-    def _execute(self, instruction):
+    def _run_event_driven(self, code, decoded, schedule, forwards, on_issue=None):
+        """
+        Runs the simulation by jumping from one instruction boundary to the next.
+        Each instruction issues at the cycle given by the PE's issue schedule. Instructions are executed in
+        (issue cycle, PE) order, and like run() the simulation stops once any PE has issued its last instruction.
+        NOPs are skipped rather than issued, so runs of NOPs cost nothing.
+
+        Args:
+            code (list): Code for each processing element as lists of instruction tokens.
+            decoded (list): Decoded instructions for each processing element.
+            schedule (list): Issue cycle of each instruction of each processing element.
+            forwards (list): Forwarded result of each instruction of each processing element, see _forwards().
+            on_issue (function, optional): Called for every issued instruction. Defaults to None.
+
+        Returns:
+            int: The total number of cycles executed.
+        """
+        last_cycle = self._last_cycle(code, schedule)
+
+        #NOPs do nothing, so only the other instructions issuing by last_cycle become events
+        positions = [[pos for pos, instruction in enumerate(pe_code) if instruction[0] != "NOP" and schedule[pe][pos] <= last_cycle]
+                     for pe, pe_code in enumerate(code)]
+        events = [(schedule[pe][pe_positions[0]], pe, 0) for pe, pe_positions in enumerate(positions) if pe_positions]
+        heapq.heapify(events)
+        deliveries = []
+        while events:
+            cycle, pe, index = heapq.heappop(events)
+            pos = positions[pe][index]
+            self._deliver(deliveries, cycle)
+            decoded[pe][pos]()
+            if forwards[pe][pos]:
+                self._send(deliveries, cycle, pe, pos, forwards[pe][pos])
+            if on_issue:
+                on_issue(cycle, pe, pos, code[pe][pos])
+            if index + 1 < len(positions[pe]):
+                heapq.heappush(events, (schedule[pe][positions[pe][index + 1]], pe, index + 1))
+        return last_cycle
+
+    def _execute(self, instruction, pe=0):
         """
         Executes the given instruction.
 
         Args:
             instruction (list): The instruction to execute.
+            pe (int, optional): The PE whose register file it uses. Defaults to 0.
+        """
+        self._decode(instruction, pe)()
+
+    def _literal(self, token):
+        """
+        Converts a constant operand to the number it represents.
+
+        Args:
+            token (str): The constant, such as '4' or '2.5'.
+
+        Returns:
+            int or float: The constant's value.
+        """
+        try:
+            return int(token)
+        except ValueError:
+            return float(token)
+
+    def _decode(self, instruction, pe=0):
+        """
+        Decodes the given instruction once into a callable that executes it.
+        Its registers, memory addresses, operation and constant operands are resolved ahead of time,
+        so executing it is a single call.
+
+        Args:
+            instruction (list): The instruction to decode.
+            pe (int, optional): The PE whose register file it uses. Defaults to 0.
+
+        Returns:
+            function: Executes the instruction when called.
         """
         instruction_name = instruction[0]
-        
+        RG, MEM = self.RG[pe], self.MEM
+
         if instruction_name == "LOAD":
-            if instruction[2] not in self.MEM:
-                raise(ValueError(f'{instruction[2]} is not in Memory'))
-            self.RG[instruction[1]] = self.MEM[instruction[2]]
-            
+            dst, address = instruction[1], instruction[2]
+            def execute():
+                if address not in MEM:
+                    raise(ValueError(f'{address} is not in Memory'))
+                RG[dst] = MEM[address]
+
         elif instruction_name == "STORE":
-            if instruction[2] not in self.RG and not is_number(instruction[2]):
-                raise(ValueError(f'{instruction[2]} is not in Register Files'))
-            self.MEM[instruction[1]] = self.RG[instruction[2]] if not is_number(instruction[2]) else float(instruction[2])
-        
-        elif instruction_name in ["ADD","SUB", "MUL", "DIV", "SQRT"]:
-            operator_map = {
-                'ADD': '+',
-                'SUB': '-',
-                'MUL': '*',
-                'DIV': '/',
+            address, src = instruction[1], instruction[2]
+            if is_number(src):
+                value = float(src)
+                def execute():
+                    MEM[address] = value
+            else:
+                def execute():
+                    if src not in RG:
+                        raise(ValueError(f'{src} is not in Register Files'))
+                    MEM[address] = RG[src]
+
+        elif instruction_name in self.operations:
+            operation = self.operations[instruction_name]
+            dst, x, y = instruction[1], instruction[2], instruction[3]
+            if x[0] == 't' and y[0] == 't':
+                def execute():
+                    RG[dst] = operation(RG[x], RG[y])
+            elif x[0] == 't':
+                y = self._literal(y)
+                def execute():
+                    RG[dst] = operation(RG[x], y)
+            elif y[0] == 't':
+                x = self._literal(x)
+                def execute():
+                    RG[dst] = operation(x, RG[y])
+            else:
+                x, y = self._literal(x), self._literal(y)
+                def execute():
+                    RG[dst] = operation(x, y)
+
+        elif instruction_name == "SQRT":
+            dst, x = instruction[1], instruction[2]
+            if x[0] == 't':
+                def execute():
+                    RG[dst] = math.sqrt(float(RG[x]))
+            else:
+                x = float(x)
+                def execute():
+                    RG[dst] = math.sqrt(x)
+
+        elif instruction_name == "FMA":
+            dst, x, y, z = instruction[1], instruction[2], instruction[3], instruction[4]
+            if x[0] == 't' and y[0] == 't' and z[0] == 't':
+                def execute():
+                    RG[dst] = RG[x] * RG[y] + RG[z]
+            else:
+                x, y, z = [token if token[0] == 't' else self._literal(token) for token in (x, y, z)]
+                value = lambda operand: RG[operand] if isinstance(operand, str) else operand
+                def execute():
+                    RG[dst] = value(x) * value(y) + value(z)
+
+        elif instruction_name == "NOP":
+            def execute():
+                pass
+
+        else:
+            raise(ValueError(f'Unknown Instruction: {instruction}'))
+
+        return execute
+
+class BatchSimulator(Simulator):
+    """
+    A class that simulates the same multi-PE code against many memory images at once.
+    MEM is a NumPy matrix with one row per memory address and one column (lane) per memory image, and RG holds
+    such a matrix for each PE's register file, so each decoded instruction runs as one vectorized operation across all lanes.
+    Lanes follow IEEE arithmetic, so a division by zero or square root of a negative number gives inf or nan
+    in that lane instead of raising.
+    """
+
+    def __init__(self, pes, file_path, addresses, values) -> None:
+        """
+        Initializes the BatchSimulator.
+
+        Args:
+            pes (int): The number of processing elements (PEs).
+            file_path (str): The path to the input files.
+            addresses (list): Memory addresses, such as from load_mem_batch().
+            values (numpy.ndarray): Matrix of values with one row per address and one column per memory image.
+        """
+        if np is None:
+            raise(ImportError("NumPy is required for the BatchSimulator."))
+        super().__init__(pes, file_path)
+        self.addresses = list(addresses)
+        self.values = np.asarray(values, dtype=float).reshape(len(self.addresses), -1)
+        self.lanes = self.values.shape[1]
+        self.mem_ids = {}
+        self.reg_ids = {}
+        self.MEM = np.empty((0, self.lanes))
+        self.RG = np.empty((pes, 0, self.lanes))
+        self.operations = {
+                'ADD': np.add,
+                'SUB': np.subtract,
+                'MUL': np.multiply,
+                'DIV': np.true_divide,
             }
-            x =  self.RG[instruction[2]] if instruction[2][0] == 't' else instruction[2]
-            if instruction_name != 'SQRT':
-                y =  self.RG[instruction[3]] if instruction[3][0] == 't' else instruction[3]
-                expression =  str(x)  +  operator_map[instruction_name]  + str(y)
-                self.RG[instruction[1]] = eval(expression)
+
+    def run(self, code=None):
+        """
+        Runs the simulation for every memory image.
+        Instructions are executed in the same order as Simulator.run(fast=True).
+
+        Args:
+            code (CompiledProgram or list, optional): Compiled code from CodeGen, or code for each processing
+                element as lists of instruction tokens. Defaults to loading the code from the input files.
+
+        Returns:
+            int: The total number of cycles executed.
+        """
+        code = self._prepare_code(code)
+
+        #Every stored address and written register gets a row, starting as nan
+        stored = [instruction[1] for pe_code in code for instruction in pe_code if instruction[0] == "STORE"]
+        registers = [token for pe_code in code for instruction in pe_code if instruction[0] not in ["STORE", "NOP"]
+                     for token in instruction[1:] if token[0] == 't']
+        self.mem_ids = {address: row for row, address in enumerate(dict.fromkeys(self.addresses + stored))}
+        self.reg_ids = {register: row for row, register in enumerate(dict.fromkeys(registers))}
+        self.MEM = np.full((len(self.mem_ids), self.lanes), np.nan)
+        self.MEM[:len(self.addresses)] = self.values
+        self.RG = np.full((self.pe_count, len(self.reg_ids), self.lanes), np.nan)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return super().run(code, fast=True)
+
+    def memory(self, lane):
+        """
+        Gets the memory of one memory image in the same form as Simulator.MEM.
+
+        Args:
+            lane (int): The memory image.
+
+        Returns:
+            dict: Address value pairs, leaving out stored addresses that were never written.
+        """
+        return {address: float(self.MEM[row, lane]) for address, row in self.mem_ids.items()
+                if address in self.addresses or not np.isnan(self.MEM[row, lane])}
+
+    def _read_register(self, pe, register):
+        """
+        Reads a register from a PE's register file, copied so later writes to it do not change the value.
+
+        Args:
+            pe (int): The PE.
+            register (str): The register.
+
+        Returns:
+            numpy.ndarray: The register's value in every lane.
+        """
+        return self.RG[pe, self.reg_ids[register]].copy()
+
+    def _write_register(self, pe, register, value):
+        """
+        Writes a register in a PE's register file.
+
+        Args:
+            pe (int): The PE.
+            register (str): The register.
+            value (numpy.ndarray): The value to write in every lane.
+        """
+        self.RG[pe, self.reg_ids[register]] = value
+
+    def _decode(self, instruction, pe=0):
+        """
+        Decodes the given instruction once into a callable that executes it across all lanes.
+        Its register and memory rows are bound as views ahead of time.
+
+        Args:
+            instruction (list): The instruction to decode.
+            pe (int, optional): The PE whose register file it uses. Defaults to 0.
+
+        Returns:
+            function: Executes the instruction when called.
+        """
+        instruction_name = instruction[0]
+        RG, MEM = self.RG[pe], self.MEM
+
+        if instruction_name == "LOAD":
+            if instruction[2] not in self.mem_ids:
+                raise(ValueError(f'{instruction[2]} is not in Memory'))
+            dst, src = RG[self.reg_ids[instruction[1]]], MEM[self.mem_ids[instruction[2]]]
+            def execute():
+                np.copyto(dst, src)
+
+        elif instruction_name == "STORE":
+            dst, src = MEM[self.mem_ids[instruction[1]]], instruction[2]
+            if is_number(src):
+                value = float(src)
+                def execute():
+                    dst.fill(value)
             else:
-                self.RG[instruction[1]] = math.sqrt(float(x))
+                src = RG[self.reg_ids[src]]
+                def execute():
+                    np.copyto(dst, src)
+
+        elif instruction_name in self.operations:
+            operation = self.operations[instruction_name]
+            dst = RG[self.reg_ids[instruction[1]]]
+            x, y = [RG[self.reg_ids[token]] if token[0] == 't' else float(token) for token in instruction[2:4]]
+            def execute():
+                operation(x, y, out=dst)
+
+        elif instruction_name == "SQRT":
+            dst = RG[self.reg_ids[instruction[1]]]
+            x = RG[self.reg_ids[instruction[2]]] if instruction[2][0] == 't' else float(instruction[2])
+            def execute():
+                np.sqrt(x, out=dst)
+
+        elif instruction_name == "FMA":
+            dst = RG[self.reg_ids[instruction[1]]]
+            x, y, z = [RG[self.reg_ids[token]] if token[0] == 't' else float(token) for token in instruction[2:5]]
+            def execute():
+                np.add(np.multiply(x, y), z, out=dst)
 
         elif instruction_name == "NOP":
-            pass
+            def execute():
+                pass
 
         else:
             raise(ValueError(f'Unknown Instruction: {instruction}'))
-        
+
+        return execute
+
+#Parsed IR shared by every worker process of a core-count sweep, so it is only sent once per worker
+_sweep_IR = None
+
+def _init_sweep_worker(IR):
+    """
+    Stores the parsed IR in a sweep worker process.
+
+    Args:
+        IR (list): The parsed IR.
+    """
+    global _sweep_IR
+    _sweep_IR = IR
+
+def _sweep_core_count(num_PEs, scheduler, mem, program=None):
+    """
+    Simulates the shared IR for one core count, compiling it first unless its compiled program is given.
+
+    Args:
+        num_PEs (int): The number of processing elements (PEs).
+        scheduler (str): The CodeGen scheduler.
+        mem (dict): Initial memory values by address.
+        program (CompiledProgram, optional): The already compiled program, such as a compile cache hit. Defaults to None.
+
+    Returns:
+        dict: The core count, simulated cycles, makespan, NOP ratio and final memory,
+            and the compiled program when it was compiled here.
+    """
+    with redirect_stdout(io.StringIO()):
+        compiled = program is None
+        if compiled:
+            program = CodeGen(num_PEs, scheduler=scheduler).generate_compiled_code(_sweep_IR, write_files=False)
+        simulator = Simulator(num_PEs, "")
+        simulator.MEM.update(mem)
+        cycles = simulator.run(program, fast=True)
+
+    #Every PE cycle of the makespan that is not spent issuing an instruction is a NOP or idle
+    busy = sum(simulator.issue_cycles[instruction[0]] for pe_code in program.pe_code for instruction in pe_code if instruction[0] != "NOP")
+    pe_cycles = num_PEs * program.makespan
+    result = {
+        "cores": num_PEs,
+        "cycles": cycles,
+        "makespan": program.makespan,
+        "nop_ratio": round(1 - busy / pe_cycles, 3) if pe_cycles else 0.0,
+        "memory": simulator.MEM,
+    }
+    if compiled:
+        result["program"] = program
+    return result
+
+def sweep_core_counts(IR, mem, core_counts, scheduler=None, max_workers=None, programs=None):
+    """
+    Compiles and simulates the IR for a range of core counts in parallel worker processes.
+    The single core run is always included, as the baseline for speed-up and correctness.
+    Core counts with a program in programs are only simulated, and the programs compiled
+    by the workers are added to it, so callers can look them up in and store them to a CompileCache.
+
+    Args:
+        IR (list): The parsed IR from Parser.parse().
+        mem (dict or list): Initial memory values, as a dict or as (address, value) pairs from load_mem().
+        core_counts (iterable): The core counts to sweep.
+        scheduler (str, optional): The CodeGen scheduler. Defaults to None, picking one with default_scheduler().
+        max_workers (int, optional): The number of worker processes. Defaults to the number of host cores.
+        programs (dict, optional): Compiled programs by core count, filled in with the programs compiled by the sweep.
+            Defaults to None, compiling every core count.
+
+    Returns:
+        list: For each core count, a dict of its cycles, makespan, speed-up, efficiency, NOP ratio,
+            and whether its final memory equals the single core memory.
+    """
+    mem = dict(mem)
+    programs = {} if programs is None else programs
+    core_counts = sorted(set(core_counts) | {1})
+    with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(), initializer=_init_sweep_worker, initargs=(IR,)) as executor:
+        results = list(executor.map(_sweep_core_count, core_counts, repeat(scheduler), repeat(mem), [programs.get(cores) for cores in core_counts]))
+
+    baseline_cycles, baseline_memory = results[0]["cycles"], results[0]["memory"]
+    for result in results:
+        if "program" in result:
+            programs[result["cores"]] = result.pop("program")
+        speed_up = baseline_cycles / result["cycles"] if result["cycles"] else 0.0
+        result["speed_up"] = round(speed_up, 3)
+        result["efficiency"] = round(speed_up / result["cores"], 3)
+        result["correct"] = result.pop("memory") == baseline_memory
+    return results
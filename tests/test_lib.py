@@ -0,0 +1,319 @@
+import json
+
+import pytest
+
+from lib import *
+
+SEEDS = range(6)
+SCHEDULERS = ["balance", "critical_path"]
+MEMORY = {f"x{address}": float(address + 1) for address in range(4)}
+#Every optimization that parse() can switch off, switched off, as the reference the optimized IR is checked against
+UNOPTIMIZED = {"rename": False, "reassociate": False, "strength_reduction": False, "fma": False}
+
+
+# Parses a program without the DFG, which shells out to graphviz
+def parse_code(code, **options):
+    return Parser().parse(code, dfg=None, **options)[0]
+
+# Parses a generated program
+def parse(seed, **options):
+    return parse_code(generate_program(40 + 30 * seed, width=1 + seed % 4, seed=seed), **options)
+
+# Compiles the IR without writing the code files
+def compile_program(IR, num_PEs, scheduler=None, registers=None):
+    return CodeGen(num_PEs, scheduler=scheduler, registers=registers).generate_compiled_code(IR, write_files=False)
+
+# Simulates on a new Simulator, returning the cycles and the Simulator for its memory and counters
+def simulate(code, num_PEs, fast=False, memory=MEMORY):
+    simulator = Simulator(num_PEs, "")
+    simulator.MEM.update(memory)
+    cycles = simulator.run(code, fast=fast, trace=TRACE_OFF)
+    return cycles, simulator
+
+# Parses, compiles and simulates a program, returning the cycles and the final memory
+def run_code(code, memory, num_PEs=1, scheduler=None, **options):
+    cycles, simulator = simulate(compile_program(parse_code(code, **options), num_PEs, scheduler), num_PEs, memory=memory)
+    return cycles, simulator.MEM
+
+
+@pytest.mark.request("user-004")
+def test_value_numbering_removes_recomputations_and_keeps_values():
+    # t4 and t6 recompute t3, t8 reloads x before it is stored to, t9 loads the stored value
+    code = ("t1=LOAD(x); t2=LOAD(y); t3=t1+t2; t4=t2+t1; t5=t3*t4; t6=t1+t2; t7=t6-t5; STORE(z , t7 );"
+            "t8=LOAD(x); STORE(x , t5 ); t9=LOAD(x); t10=t8+t9; STORE(w , t10 );")
+    memory = {"x": 3.0, "y": 5.0}
+    IR = parse_code(code)
+    assert [instruction[0] for instruction in IR].count("ADD") == 2
+    assert [instruction[0] for instruction in IR].count("LOAD") == 3
+    assert ("MUL", "t5", "t3", "t3") in [instruction[:-1] for instruction in IR]
+    for num_PEs in [1, 2, 3]:
+        _, values = run_code(code, memory, num_PEs)
+        assert values == {"x": 64.0, "y": 5.0, "z": -56.0, "w": 67.0}
+
+
+@pytest.mark.request("user-006", "user-025")
+@pytest.mark.parametrize("scheduler", SCHEDULERS)
+@pytest.mark.parametrize("seed", SEEDS)
+def test_multi_core_memory_matches_single_core(seed, scheduler):
+    IR = parse(seed)
+    _, single_core = simulate(compile_program(IR, 1, scheduler), 1)
+    for num_PEs in [2, 3, 5]:
+        _, multi_core = simulate(compile_program(IR, num_PEs, scheduler), num_PEs)
+        assert multi_core.MEM == single_core.MEM
+
+
+@pytest.mark.request("user-010")
+@pytest.mark.parametrize("seed", SEEDS)
+def test_fast_matches_cycle_loop(seed):
+    program = compile_program(parse(seed), 3)
+    cycles, simulator = simulate(program, 3)
+    fast_cycles, fast_simulator = simulate(program, 3, fast=True)
+    assert fast_cycles == cycles
+    assert fast_simulator.MEM == simulator.MEM
+    assert fast_simulator.counters == simulator.counters
+
+
+@pytest.mark.request("user-011")
+@pytest.mark.parametrize("seed", SEEDS)
+def test_batch_simulator_matches_simulator_per_lane(seed):
+    np = pytest.importorskip("numpy")
+    program = compile_program(parse(seed), 3)
+    addresses = list(MEMORY)
+    values = np.array([[MEMORY[address] * (1 + lane / 2) for lane in range(4)] for address in addresses])
+    simulator = BatchSimulator(3, "", addresses, values)
+    cycles = simulator.run(program)
+    for lane in range(4):
+        lane_cycles, reference = simulate(program, 3, fast=True, memory=dict(zip(addresses, values[:, lane])))
+        assert cycles == lane_cycles
+        assert simulator.memory(lane) == pytest.approx(reference.MEM, nan_ok=True)
+
+
+@pytest.mark.request("user-013")
+@pytest.mark.parametrize("seed", SEEDS)
+def test_binary_round_trip(seed, tmp_path):
+    program = compile_program(parse(seed), 3)
+    write_compiled_binary(program, str(tmp_path / "program.bin"))
+    code = read_compiled_binary(str(tmp_path / "program.bin"))
+
+    # NOP runs stay encoded, as in the compiled program
+    assert code == program.code()
+
+    write_compiled_binary(code, str(tmp_path / "round_trip.bin"))
+    assert (tmp_path / "round_trip.bin").read_bytes() == (tmp_path / "program.bin").read_bytes()
+
+    cycles, simulator = simulate(program, 3)
+    binary_cycles, binary_simulator = simulate(code, 3)
+    assert binary_cycles == cycles
+    assert binary_simulator.MEM == simulator.MEM
+    assert binary_simulator.counters == simulator.counters
+
+
+@pytest.mark.request("user-014")
+def test_compile_cache_round_trips_and_evicts(tmp_path):
+    cache = CompileCache(str(tmp_path))
+    code = generate_program(60, seed=1)
+    ir_key = cache.key(code)
+    assert len({ir_key, cache.key(code + " "), cache.key(code, 3, "balance"), cache.key(code, 3, "critical_path"),
+                cache.key(code, 2, "balance")}) == 5
+    assert cache.get(ir_key) is None
+
+    parsed = Parser().parse(code, dfg=None)
+    cache.put(ir_key, parsed)
+    assert cache.get(ir_key) == parsed
+    program = compile_program(parsed[0], 3)
+    cache.put(cache.key(code, 3, "balance"), program)
+    assert cache.get(cache.key(code, 3, "balance")).code() == program.code()
+
+    # A corrupt entry is a miss
+    (tmp_path / (ir_key + ".pkl")).write_bytes(b"not a pickle")
+    assert cache.get(ir_key) is None
+
+    # Only the most recently used entry fits
+    cache = CompileCache(str(tmp_path), max_bytes=(tmp_path / (cache.key(code, 3, "balance") + ".pkl")).stat().st_size)
+    cache.put(cache.key(code, 2, "balance"), program)
+    assert cache.get(cache.key(code, 2, "balance")) is not None
+    assert cache.get(cache.key(code, 3, "balance")) is None
+    assert cache.get(ir_key) is None
+
+
+@pytest.mark.request("user-015")
+def test_sweep_matches_simulation_and_reuses_programs():
+    IR = parse(2)
+    programs = {}
+    results = sweep_core_counts(IR, MEMORY, [2, 3], scheduler="balance", max_workers=2, programs=programs)
+    assert [result["cores"] for result in results] == [1, 2, 3]
+    assert all(result["correct"] for result in results)
+    assert sorted(programs) == [1, 2, 3]
+    for result in results:
+        cycles, _ = simulate(programs[result["cores"]], result["cores"], fast=True)
+        assert result["cycles"] == cycles
+        assert result["makespan"] == programs[result["cores"]].makespan
+
+    # Programs already compiled are only simulated, and kept as they are
+    compiled = dict(programs)
+    assert sweep_core_counts(IR, MEMORY, [2, 3], scheduler="balance", max_workers=2, programs=programs) == results
+    assert all(programs[cores] is program for cores, program in compiled.items())
+
+
+@pytest.mark.request("user-017")
+@pytest.mark.parametrize("fast", [False, True])
+def test_trace_file_and_buffer(fast, tmp_path):
+    program = compile_program(parse(1), 3)
+    simulator = Simulator(3, "")
+    simulator.MEM.update(MEMORY)
+    cycles = simulator.run(program, fast=fast, trace=TRACE_OFF, trace_buffer=5, trace_file=str(tmp_path / "trace.csv"))
+    retired = sum(counters["retired"] for counters in simulator.counters["pes"])
+
+    lines = (tmp_path / "trace.csv").read_text().splitlines()
+    assert lines[0] == "cycle,pe,position,instruction"
+    events = [line.split(",", 3) for line in lines[1:]]
+    assert len(events) == retired
+    for cycle, pe, pos, instruction in events:
+        assert instruction == " ".join(program.code()[int(pe)][int(pos)])
+    assert [int(cycle) for cycle, *_ in events] == sorted(int(cycle) for cycle, *_ in events)
+
+    # The buffer keeps the instructions issued in the last 5 cycles
+    assert simulator.trace == [(int(cycle), int(pe), int(pos), program.code()[int(pe)][int(pos)])
+                               for cycle, pe, pos, _ in events if int(cycle) > cycles - 5]
+
+    simulator.run(program, fast=fast, trace=TRACE_OFF, trace_file=str(tmp_path / "trace.bin"))
+    assert (tmp_path / "trace.bin").stat().st_size == retired * TraceWriter.RECORD.size
+
+
+@pytest.mark.request("user-017")
+def test_trace_writer_raises_writer_thread_errors(tmp_path):
+    writer = TraceWriter(str(tmp_path / "trace.csv"), batch_size=1)
+    writer._file.close()
+    with pytest.raises(ValueError):
+        for cycle in range(1, 1000):
+            writer.write(cycle, 0, 0, ["ADD", "t1", "t2", "t3"])
+        writer.close()
+
+
+@pytest.mark.request("user-018")
+def test_profiler_records_size_range_over_calls():
+    profiler = Profiler(trace_memory=False)
+    parser = Parser()
+    parser.add_hook(profiler)
+    IR = parser.parse(generate_program(80, width=2, seed=3), dfg=None)[0]
+    codegen = CodeGen(3, scheduler="balance")
+    codegen.add_hook(profiler)
+    codegen.generate_compiled_code(IR, write_files=False)
+    report = profiler.report()
+
+    # The dependency analysis runs after each pass, on 80 instructions first and on the 15 left last
+    assert report["dependencies"]["calls"] > 1
+    assert report["dependencies"]["size_before"] == [len(IR), 80]
+    assert report["tokenize"]["size_before"] == [80, 80]
+    assert report["rebalance_iteration"]["size_before"] is None
+    assert set(report) >= {"register_renaming", "balance_workload", "sync", "compiled_program"}
+
+
+@pytest.mark.request("user-021")
+@pytest.mark.parametrize("seed", SEEDS)
+def test_renaming_keeps_values(seed):
+    IR = parse(seed)
+    for instruction in IR:
+        assert instruction[0] == "STORE" or sum(other[1] == instruction[1] for other in IR if other[0] != "STORE") == 1
+    _, renamed = simulate(compile_program(IR, 3), 3)
+    _, reference = simulate(compile_program(parse(seed, **UNOPTIMIZED), 1), 1)
+    assert renamed.MEM == reference.MEM
+
+
+@pytest.mark.request("user-021")
+def test_renaming_skips_names_in_use():
+    code = "t4=LOAD(x); t9=LOAD(y); t4=^t4; t4_1=t9+t9; t5=t4+t4_1; STORE(z , t5 );"
+    memory = {"x": 16.0, "y": 100.0}
+    _, reference = run_code(code, memory, **UNOPTIMIZED)
+    assert reference["z"] == 204.0
+    for num_PEs in [1, 2]:
+        assert run_code(code, memory, num_PEs)[1] == reference
+
+
+@pytest.mark.request("user-021")
+@pytest.mark.parametrize("seed", SEEDS)
+def test_register_allocation_keeps_values_within_budget(seed):
+    IR = parse(seed)
+    _, reference = simulate(compile_program(IR, 3), 3)
+    unbounded = CodeGen(3, registers=len(IR))
+    unbounded.generate_compiled_code(IR, write_files=False)
+    budget = max(unbounded.register_pressure)
+
+    codegen = CodeGen(3, registers=budget)
+    program = codegen.generate_compiled_code(IR, write_files=False)
+    assert codegen.register_pressure == unbounded.register_pressure
+    for pe, pe_code in enumerate(program.code()):
+        written = {instruction[1] for instruction in pe_code if instruction[0] not in ["NOP", "STORE"]}
+        assert written <= {f"t{pe}_r{register}" for register in range(budget)}
+    _, allocated = simulate(program, 3)
+    assert allocated.MEM == reference.MEM
+
+    # Nothing is spilled, so a budget under the peak pressure raises
+    with pytest.raises(ValueError):
+        compile_program(IR, 3, registers=budget - 1)
+
+
+@pytest.mark.request("user-022")
+def test_reassociation_balances_long_chains():
+    # A 500 long serial ADD chain, deeper than the recursion limit of a recursive tree walk
+    code = "t0=LOAD(x);" + "".join(f"t{register}=t{register - 1}+t0;" for register in range(1, 500)) + "STORE(y , t499 );"
+    memory = {"x": 1.5}
+    serial_cycles, reference = run_code(code, memory, 4, **UNOPTIMIZED)
+    balanced_cycles, balanced = run_code(code, memory, 4, reassociate=True)
+    assert reference["y"] == 750.0
+    assert balanced == reference
+    assert balanced_cycles < serial_cycles / 2
+
+
+@pytest.mark.request("user-023")
+def test_strength_reduction_is_opt_in_and_keeps_values():
+    code = "t1=LOAD(x); t2=LOAD(y); t3=t2/8; t4=t1*2; t5=t3+t4; STORE(z , t5 );"
+    memory = {"x": 10.0, "y": 20.0}
+    assert [instruction[0] for instruction in parse_code(code)] == ["LOAD", "LOAD", "DIV", "MUL", "ADD", "STORE"]
+
+    IR = parse_code(code, strength_reduction=True)
+    assert ("MUL", "t3", "t2", "0.125") in [instruction[:-1] for instruction in IR]
+    assert ("ADD", "t4", "t1", "t1") in [instruction[:-1] for instruction in IR]
+    _, reference = run_code(code, memory, **UNOPTIMIZED)
+    assert reference["z"] == 22.5
+    assert run_code(code, memory, 2, strength_reduction=True)[1] == reference
+
+
+@pytest.mark.request("user-023")
+def test_fma_fuses_multiply_add_and_keeps_values():
+    code = "t1=LOAD(x); t2=LOAD(y); t3=t1*t2; t4=t3+t1; STORE(z , t4 );"
+    memory = {"x": 3.0, "y": 5.0}
+    IR = parse_code(code, strength_reduction=True, fma=True)
+    assert [instruction[0] for instruction in IR] == ["LOAD", "LOAD", "FMA", "STORE"]
+    _, reference = run_code(code, memory, **UNOPTIMIZED)
+    assert reference["z"] == 18.0
+    assert run_code(code, memory, 2, strength_reduction=True, fma=True)[1] == reference
+    with pytest.raises(ValueError):
+        parse_code(code, fma=True)
+
+
+@pytest.mark.request("user-024")
+def test_counters_split_stalls(tmp_path, monkeypatch):
+    # The repository's table with a pipelined MUL, whose result the ADD waits for on the same PE
+    with open("input/operation_latency.json") as file:
+        table = json.load(file)
+    table["MUL"] = {"latency": 4, "interval": 1}
+    (tmp_path / "input").mkdir()
+    (tmp_path / "input" / "operation_latency.json").write_text(json.dumps(table))
+    monkeypatch.chdir(tmp_path)
+
+    code = "t1=LOAD(x); t2=t1*t1; t3=t2+1; STORE(y , t3 );"
+    _, simulator = simulate(compile_program(parse_code(code), 1), 1, memory={"x": 3.0})
+    assert simulator.MEM["y"] == 10.0
+    counters = simulator.counters["pes"][0]
+    assert counters["busy_cycles"]["MUL"] == 1
+    assert counters["in_flight_cycles"]["MUL"] == 4
+    assert counters["stall_cycles"] == counters["latency_stall_cycles"] == 3
+    assert counters["remote_stall_cycles"] == counters["unit_stall_cycles"] == 0
+
+    # Across PEs every stall is put down to exactly one cause
+    for num_PEs in [2, 3]:
+        _, simulator = simulate(compile_program(parse(3), num_PEs), num_PEs)
+        for counters in simulator.counters["pes"]:
+            causes = ["remote_stall_cycles", "latency_stall_cycles", "unit_stall_cycles"]
+            assert counters["stall_cycles"] == sum(counters[cause] for cause in causes)